@@ -31,34 +31,30 @@ import pox.openflow.libopenflow_01 as of
 import pox.lib.packet as pkt
 import networkx as NX
 
+import heapq
 import struct
 import time
-from collections import namedtuple
+from collections import namedtuple, defaultdict, deque
 from random import shuffle, random
 
 
 log = core.getLogger()
 
-class ResponsePathEvent(Event):
-    def __init__(self, path):
-        Event.__init__(self)
-        self.path = path
-
-class SendLink(Event):
-    def __init__(self, link):
-      Event.__init__(self)
-      self.link = link
-
 class LLDPSender (object):
   """
   Sends out discovery packets
   """
 
-  SendItem = namedtuple("LLDPSenderItem", ('dpid','port_num','packet'))
+  SendItem = namedtuple("LLDPSenderItem", ('dpid','port_num','packet','frames'))
 
-  #NOTE: This class keeps the packets to send in a flat list, which makes
-  #      adding/removing them on switch join/leave or (especially) port
-  #      status changes relatively expensive. Could easily be improved.
+  # Discovery frames come back the way they were sent, or padded to the
+  # minimum Ethernet frame size
+  _min_frame_len = 60
+
+  # Packets to send are kept in two deques (this cycle's and the next's)
+  # plus a (dpid, port_num) -> item index. Removing a port only drops it
+  # from the index; its queued item is skipped when it comes up (or when
+  # the queues are compacted), so add, remove and send are all O(1).
 
   # Maximum times to run the timer per second
   _sends_per_sec = 15
@@ -76,10 +72,23 @@ class LLDPSender (object):
       other LLDP agents might.  Can't be 0 (this means revoke).
     """
     # Packets remaining to be sent in this cycle
-    self._this_cycle = []
+    self._this_cycle = deque()
 
     # Packets we've already sent in this cycle
-    self._next_cycle = []
+    self._next_cycle = deque()
+
+    # Live item of each (dpid, port_num); queued items not in here are stale
+    self._items = {}
+
+    # Port numbers of each dpid with a live item
+    self._ports = defaultdict(set)
+
+    # Number of stale items still in the queues
+    self._stale = 0
+
+    # Raw bytes of every discovery frame we send -> (dpid, port_num), so
+    # our own LLDP packets are recognized without parsing them
+    self.originators = {}
 
     # Packets to send in a batch
     self._send_chunk_size = 1
@@ -116,30 +125,53 @@ class LLDPSender (object):
     self.del_switch(event.dpid)
 
   def del_switch (self, dpid, set_timer = True):
-    self._this_cycle = [p for p in self._this_cycle if p.dpid != dpid]
-    self._next_cycle = [p for p in self._next_cycle if p.dpid != dpid]
+    for port_num in list(self._ports.get(dpid, ())):
+      self.del_port(dpid, port_num, set_timer = False)
     if set_timer: self._set_timer()
 
   def del_port (self, dpid, port_num, set_timer = True):
     if port_num > of.OFPP_MAX: return
-    self._this_cycle = [p for p in self._this_cycle
-                        if p.dpid != dpid or p.port_num != port_num]
-    self._next_cycle = [p for p in self._next_cycle
-                        if p.dpid != dpid or p.port_num != port_num]
+    item = self._items.pop((dpid, port_num), None)
+    if item is None: return
+    for frame in item.frames:
+      self.originators.pop(frame, None)
+    ports = self._ports[dpid]
+    ports.discard(port_num)
+    if not ports: del self._ports[dpid]
+    self._stale += 1
+    if self._stale > len(self._items) + 16:
+      self._compact()
     if set_timer: self._set_timer()
 
   def add_port (self, dpid, port_num, port_addr, set_timer = True):
     if port_num > of.OFPP_MAX: return
     self.del_port(dpid, port_num, set_timer = False)
-    packet = self.create_packet_out(dpid, port_num, port_addr)
-    self._next_cycle.insert(0, LLDPSender.SendItem(dpid, port_num, packet))
+    packet, frame = self.create_packet_out(dpid, port_num, port_addr)
+    frames = (frame, frame.ljust(self._min_frame_len, b'\0'))
+    for f in frames:
+      self.originators[f] = (dpid, port_num)
+    item = LLDPSender.SendItem(dpid, port_num, packet, frames)
+    self._items[dpid, port_num] = item
+    self._ports[dpid].add(port_num)
+    self._next_cycle.appendleft(item)
     if set_timer: self._set_timer()
     core.openflow.sendToDPID(dpid, packet) # Send one immediately
 
+  def _is_live (self, item):
+    return self._items.get((item.dpid, item.port_num)) is item
+
+  def _compact (self):
+    """
+    Drop the stale items from the queues
+    """
+    self._this_cycle = deque(p for p in self._this_cycle if self._is_live(p))
+    self._next_cycle = deque(p for p in self._next_cycle if self._is_live(p))
+    self._stale = 0
+
   def _set_timer (self):
     if self._timer: self._timer.cancel()
     self._timer = None
-    num_packets = len(self._this_cycle) + len(self._next_cycle)
+    num_packets = len(self._items)
 
     if num_packets == 0: return
 
@@ -158,31 +190,40 @@ class LLDPSender (object):
     """
     Called by a timer to actually send packets.
 
-    Picks the first packet off this cycle's list, sends it, and then puts
-    it on the next-cycle list.  When this cycle's list is empty, starts
-    the next cycle.
+    Picks the first packet off this cycle's queue, sends it, and then puts
+    it on the next-cycle queue.  When this cycle's queue is empty, starts
+    the next cycle.  Stale items are dropped on the way.
     """
     num = int(self._send_chunk_size)
     fpart = self._send_chunk_size - num
     if random() < fpart: num += 1
 
     for _ in range(num):
-      if len(self._this_cycle) == 0:
-        self._this_cycle = self._next_cycle
-        self._next_cycle = []
-        #shuffle(self._this_cycle)
-      item = self._this_cycle.pop(0)
+      item = None
+      while item is None:
+        if len(self._this_cycle) == 0:
+          if len(self._next_cycle) == 0: return
+          self._this_cycle = self._next_cycle
+          self._next_cycle = deque()
+          #shuffle(self._this_cycle)
+        item = self._this_cycle.popleft()
+        if not self._is_live(item):
+          self._stale -= 1
+          item = None
       self._next_cycle.append(item)
       core.openflow.sendToDPID(item.dpid, item.packet)
 
   def create_packet_out (self, dpid, port_num, port_addr):
     """
     Create an ofp_packet_out containing a discovery packet
+
+    Returns the packed packet_out and the discovery frame in it.
     """
     eth = self._create_discovery_packet(dpid, port_num, port_addr, self._ttl)
+    frame = eth.pack()
     po = of.ofp_packet_out(action = of.ofp_action_output(port=port_num))
-    po.data = eth.pack()
-    return po.pack()
+    po.data = frame
+    return po.pack(), frame
 
   @staticmethod
   def _create_discovery_packet (dpid, port_num, port_addr, ttl):
@@ -234,6 +275,21 @@ class LinkEvent (Event):
     return None
 
 
+class TopologyDelta (Event):
+  """
+  Links which changed since the previous TopologyDelta
+
+  Raised only when links actually come up or go away (a changed port
+  shows as the old link removed and the new one added), never for LLDP
+  refreshes of known links.  version goes up by one with every delta, so
+  a listener which missed one can tell and resync from adjacency.
+  """
+  def __init__ (self, version, added, removed):
+    self.version = version
+    self.added = added     # Links which came up
+    self.removed = removed # Links which went away
+
+
 class Link (namedtuple("LinkBase",("dpid1","port1","dpid2","port2"))):
   @property
   def uni (self):
@@ -277,7 +333,7 @@ class Discovery (EventMixin):
 
   _eventMixin_events = set([
     LinkEvent,
-    SendLink
+    TopologyDelta,
   ])
 
   _core_name = "openflow_discovery" # we want to be core.openflow_discovery
@@ -285,13 +341,29 @@ class Discovery (EventMixin):
   Link = Link
 
   def __init__ (self, install_flow = True, explicit_drop = True,
-                link_timeout = None, eat_early_packets = False):
+                link_timeout = None, eat_early_packets = False,
+                coalesce = 0):
     self._eat_early_packets = eat_early_packets
     self._explicit_drop = explicit_drop
     self._install_flow = install_flow
     if link_timeout: self._link_timeout = link_timeout
 
     self.adjacency = {} # From Link to time.time() stamp
+    self._links_by_dpid = defaultdict(set) # dpid -> Links on it
+    self._links_by_port = defaultdict(set) # (dpid, port) -> Links on it
+    # Heap of (deadline, Link), at most one entry per Link.  Refreshing a
+    # link only updates its adjacency stamp; when the entry comes due, it
+    # is pushed again with the new deadline if the link was refreshed.
+    self._expiry = []
+    self._scheduled = set() # Links with an entry in _expiry
+
+    # Changes not yet raised as a TopologyDelta (dicts keep their order).
+    # With coalesce set, changes within that many seconds go out together.
+    self.topology_version = 0
+    self._coalesce = coalesce
+    self._delta_added = {}
+    self._delta_removed = {}
+    self._delta_pending = False
     self._sender = LLDPSender(self.send_cycle_time)
 
     # Listen with a high priority (mostly so we get PacketIns early)
@@ -332,9 +404,7 @@ class Discovery (EventMixin):
 
   def _handle_openflow_ConnectionDown (self, event):
     # Delete all links on this switch
-    self._delete_links([link for link in self.adjacency
-                        if link.dpid1 == event.dpid
-                        or link.dpid2 == event.dpid])
+    self._delete_links(list(self._links_by_dpid.get(event.dpid, ())))
 
   def _expire_links (self):
     """
@@ -342,8 +412,16 @@ class Discovery (EventMixin):
     """
     now = time.time()
 
-    expired = [link for link,timestamp in self.adjacency.items()
-               if timestamp + self._link_timeout < now]
+    expired = []
+    while self._expiry and self._expiry[0][0] < now:
+      _, link = heapq.heappop(self._expiry)
+      self._scheduled.discard(link)
+      timestamp = self.adjacency.get(link)
+      if timestamp is None: continue # Already deleted
+      if timestamp + self._link_timeout < now:
+        expired.append(link)
+      else:
+        self._schedule(link, timestamp)
     if expired:
       for link in expired:
         log.info('link timeout: %s', link)
@@ -355,16 +433,20 @@ class Discovery (EventMixin):
     Receive and process LLDP packets
     """
 
-    packet = event.parsed
+    # Our own discovery packets are known by their bytes
+    originator = self._sender.originators.get(event.ofp.data)
 
-    if (packet.effective_ethertype != pkt.ethernet.LLDP_TYPE
-        or packet.dst != pkt.ETHERNET.NDP_MULTICAST):
-      if not self._eat_early_packets: return
-      if not event.connection.connect_time: return
-      enable_time = time.time() - self.send_cycle_time - 1
-      if event.connection.connect_time > enable_time:
-        return EventHalt
-      return
+    if originator is None:
+      packet = event.parsed
+
+      if (packet.effective_ethertype != pkt.ethernet.LLDP_TYPE
+          or packet.dst != pkt.ETHERNET.NDP_MULTICAST):
+        if not self._eat_early_packets: return
+        if not event.connection.connect_time: return
+        enable_time = time.time() - self.send_cycle_time - 1
+        if event.connection.connect_time > enable_time:
+          return EventHalt
+        return
 
     if self._explicit_drop:
       if event.ofp.buffer_id is not None:
@@ -374,44 +456,115 @@ class Discovery (EventMixin):
         msg.in_port = event.port
         event.connection.send(msg)
 
+    if originator is None:
+      # Someone else's LLDP (or one sent before a port changed)
+      originator = self._parse_lldp(packet)
+      if originator is None:
+        return EventHalt
+    originatorDPID, originatorPort = originator
+
+    if originatorDPID not in core.openflow.connections:
+      log.info('Received LLDP packet from unknown switch')
+      return EventHalt
+
+    if (event.dpid, event.port) == (originatorDPID, originatorPort):
+      log.warning("Port received its own LLDP packet; ignoring")
+      return EventHalt
+
+    link = Discovery.Link(originatorDPID, originatorPort, event.dpid,
+                          event.port)
+
+    if link not in self.adjacency:
+      self._add_link(link, time.time())
+      log.info('link detected: %s', link)
+      self.raiseEventNoErrors(LinkEvent, True, link, event)
+      self._note_change(link, True)
+      self._flush_changes()
+    else:
+      # Just update timestamp
+      self.adjacency[link] = time.time()
+
+    return EventHalt # Probably nobody else needs this event
+
+  def _note_change (self, link, added):
+    """
+    Record a link change for the next TopologyDelta
+    """
+    # A change undoing one still pending cancels out
+    if added:
+      if link in self._delta_removed:
+        del self._delta_removed[link]
+      else:
+        self._delta_added[link] = None
+    else:
+      if link in self._delta_added:
+        del self._delta_added[link]
+      else:
+        self._delta_removed[link] = None
+
+  def _flush_changes (self):
+    """
+    Raise the recorded changes now, or after the coalescing window
+    """
+    if self._delta_pending: return
+    if self._coalesce:
+      self._delta_pending = True
+      core.callDelayed(self._coalesce, self._raise_delta)
+    else:
+      self._raise_delta()
+
+  def _raise_delta (self):
+    self._delta_pending = False
+    if not self._delta_added and not self._delta_removed: return
+    added, removed = list(self._delta_added), list(self._delta_removed)
+    self._delta_added.clear()
+    self._delta_removed.clear()
+    self.topology_version += 1
+    self.raiseEventNoErrors(TopologyDelta, self.topology_version, added,
+                            removed)
+
+  @staticmethod
+  def _look_in_sys_desc (lldph):
+    for t in lldph.tlvs[3:]:
+      if t.tlv_type == pkt.lldp.SYSTEM_DESC_TLV:
+        # This is our favored way...
+        for line in t.payload.decode().split('\n'):
+          if line.startswith('dpid:'):
+            try:
+              return int(line[5:], 16)
+            except:
+              pass
+        if len(t.payload) == 8:
+          # Maybe it's a FlowVisor LLDP...
+          # Do these still exist?
+          try:
+            return struct.unpack("!Q", t.payload)[0]
+          except:
+            pass
+        return None
+
+  def _parse_lldp (self, packet):
+    """
+    Return the (dpid, port) an LLDP packet was sent from, or None
+    """
     lldph = packet.find(pkt.lldp)
     if lldph is None or not lldph.parsed:
       log.error("LLDP packet could not be parsed")
-      return EventHalt
+      return None
     if len(lldph.tlvs) < 3:
       log.error("LLDP packet without required three TLVs")
-      return EventHalt
+      return None
     if lldph.tlvs[0].tlv_type != pkt.lldp.CHASSIS_ID_TLV:
       log.error("LLDP packet TLV 1 not CHASSIS_ID")
-      return EventHalt
+      return None
     if lldph.tlvs[1].tlv_type != pkt.lldp.PORT_ID_TLV:
       log.error("LLDP packet TLV 2 not PORT_ID")
-      return EventHalt
+      return None
     if lldph.tlvs[2].tlv_type != pkt.lldp.TTL_TLV:
       log.error("LLDP packet TLV 3 not TTL")
-      return EventHalt
-
-    def lookInSysDesc ():
-      r = None
-      for t in lldph.tlvs[3:]:
-        if t.tlv_type == pkt.lldp.SYSTEM_DESC_TLV:
-          # This is our favored way...
-          for line in t.payload.decode().split('\n'):
-            if line.startswith('dpid:'):
-              try:
-                return int(line[5:], 16)
-              except:
-                pass
-          if len(t.payload) == 8:
-            # Maybe it's a FlowVisor LLDP...
-            # Do these still exist?
-            try:
-              return struct.unpack("!Q", t.payload)[0]
-            except:
-              pass
-          return None
+      return None
 
-    originatorDPID = lookInSysDesc()
+    originatorDPID = self._look_in_sys_desc(lldph)
 
     if originatorDPID == None:
       # We'll look in the CHASSIS ID
@@ -435,16 +588,12 @@ class Discovery (EventMixin):
 
     if originatorDPID == None:
       log.warning("Couldn't find a DPID in the LLDP packet")
-      return EventHalt
-
-    if originatorDPID not in core.openflow.connections:
-      log.info('Received LLDP packet from unknown switch')
-      return EventHalt
+      return None
 
     # Get port number from port TLV
     if lldph.tlvs[1].subtype != pkt.port_id.SUB_PORT:
       log.warning("Thought we found a DPID, but packet didn't have a port")
-      return EventHalt
+      return None
     originatorPort = None
     if lldph.tlvs[1].id.isdigit():
       # We expect it to be a decimal value
@@ -458,45 +607,47 @@ class Discovery (EventMixin):
     if originatorPort is None:
       log.warning("Thought we found a DPID, but port number didn't " +
                   "make sense")
-      return EventHalt
+      return None
 
-    if (event.dpid, event.port) == (originatorDPID, originatorPort):
-      log.warning("Port received its own LLDP packet; ignoring")
-      return EventHalt
+    return originatorDPID, originatorPort
 
-    link = Discovery.Link(originatorDPID, originatorPort, event.dpid,
-                          event.port)
-    self._send_link(link)
+  def _add_link (self, link, timestamp):
+    self.adjacency[link] = timestamp
+    self._links_by_dpid[link.dpid1].add(link)
+    self._links_by_dpid[link.dpid2].add(link)
+    self._links_by_port[link.dpid1, link.port1].add(link)
+    self._links_by_port[link.dpid2, link.port2].add(link)
+    if link not in self._scheduled:
+      self._schedule(link, timestamp)
 
-    if link not in self.adjacency:
-      self.adjacency[link] = time.time()
-      log.info('link detected: %s', link)
-      self.raiseEventNoErrors(LinkEvent, True, link, event)
-    else:
-      # Just update timestamp
-      self.adjacency[link] = time.time()
+  def _schedule (self, link, timestamp):
+    heapq.heappush(self._expiry, (timestamp + self._link_timeout, link))
+    self._scheduled.add(link)
 
-    return EventHalt # Probably nobody else needs this event
-
-  def _send_link(self, link):
-    self.raiseEvent(SendLink(link))
+  def _unindex (self, index, key, link):
+    links = index.get(key)
+    if links is None: return
+    links.discard(link)
+    if not links: del index[key]
 
   def _delete_links (self, links):
     for link in links:
       self.raiseEventNoErrors(LinkEvent, False, link)
     for link in links:
-      self.adjacency.pop(link, None)
+      if self.adjacency.pop(link, None) is None: continue
+      self._note_change(link, False)
+      # Its _expiry entry is dropped when it comes due
+      self._unindex(self._links_by_dpid, link.dpid1, link)
+      self._unindex(self._links_by_dpid, link.dpid2, link)
+      self._unindex(self._links_by_port, (link.dpid1, link.port1), link)
+      self._unindex(self._links_by_port, (link.dpid2, link.port2), link)
+    self._flush_changes()
 
   def is_edge_port (self, dpid, port):
     """
     Return True if given port does not connect to another switch
     """
-    for link in self.adjacency:
-      if link.dpid1 == dpid and link.port1 == port:
-        return False
-      if link.dpid2 == dpid and link.port2 == port:
-        return False
-    return True
+    return (dpid, port) not in self._links_by_port
 
 
 class DiscoveryGraph (EventMixin):
@@ -524,9 +675,6 @@ class DiscoveryGraph (EventMixin):
       sleep 2
     done
   """
-  _eventMixin_events = set([
-    ResponsePathEvent
-  ])
   _core_name = "openflow_discGraph"
   use_names = True
   def __init__ (self, auto_export_file=None, use_names=None,
@@ -536,6 +684,27 @@ class DiscoveryGraph (EventMixin):
     if use_names is not None: self.use_names = use_names
     self._export_pending = False
     self.g = NX.MultiDiGraph()
+
+    # Compact routing graph of live switch-to-switch links only (g is
+    # just kept for exporting).  Switches get integer ids; _adj[id] lists
+    # the ids of its live neighbors and _ports[id1, id2] the output ports
+    # of the (possibly parallel) live links for that hop.
+    self._ids = {}      # dpid -> id
+    self._dpids = []    # id -> dpid
+    self._adj = []      # id -> [neighbor id, ...]
+    self._ports = {}    # (id1, id2) -> {port: live links from it}
+    self._live_links = set()  # Links the routing graph was built from
+    # Version of the last TopologyDelta applied
+    self._delta_version = 0
+    # Bumped whenever the live adjacency changes
+    self.topology_version = 0
+    # Path table: (src_dpid, dst_dpid) -> [dpid, ...]
+    self._paths = {}
+    # (dpid1, dpid2) hop -> set of path table keys going over it
+    self._paths_by_hop = defaultdict(set)
+    # False when the table must be rebuilt from scratch on next lookup
+    self._paths_complete = False
+
     core.listen_to_dependencies(self)
 
     self._write_dot = None
@@ -549,25 +718,153 @@ class DiscoveryGraph (EventMixin):
 
     self._auto_export_interval()
 
-    core.call_when_ready(self._setup, ['misc_lclb'])
-        
-        # Method 2: Alternative direct listening if component is already running
-        # self.listenTo(core.my_event_source)
-  def _setup(self):
-      """Called when my_event_source is available"""
-      log.debug("Setting up event listener")
-      # Start listening to events from my_event_source
-      self.listenTo(core.misc_lclb)
-  
   def _auto_export_interval (self):
     if self.auto_export_interval:
       core.call_delayed(self.auto_export_interval,
                         self._auto_export_interval)
       self._do_auto_export()
 
-  def _handle_RequestPathEvent(self, event):
-    path = NX.shortest_path(self.g, event.path_endpoints[0], event.path_endpoints[1])
-    self.raiseEvent(ResponsePathEvent(path))
+  def get_path (self, src, dst):
+    """
+    Returns the shortest path from src to dst as a list of DPIDs
+
+    The lookup is synchronous and served from the path table, so it can
+    be called directly from event handlers.  Returns None if there is no
+    path.  The caller owns the returned list.
+    """
+    path = self._lookup_path(src, dst)
+    if path is None: return None
+    return list(path)
+
+  def get_port (self, src, dst):
+    """
+    Returns the port on switch src of a live link to switch dst (or None)
+    """
+    i = self._ids.get(src)
+    j = self._ids.get(dst)
+    if i is None or j is None: return None
+    ports = self._ports.get((i, j))
+    if not ports: return None
+    return next(iter(ports))
+
+  def _node_id (self, dpid):
+    i = self._ids.get(dpid)
+    if i is None:
+      i = len(self._dpids)
+      self._ids[dpid] = i
+      self._dpids.append(dpid)
+      self._adj.append([])
+    return i
+
+  def _bfs (self, src, dst = None):
+    """
+    Breadth-first search from node id src over live links
+
+    Returns the parent list (-1 for unreached nodes, src is its own
+    parent).  Stops early once dst is reached.
+    """
+    adj = self._adj
+    parent = [-1] * len(adj)
+    parent[src] = src
+    frontier = [src]
+    while frontier:
+      next_frontier = []
+      for i in frontier:
+        for j in adj[i]:
+          if parent[j] != -1: continue
+          parent[j] = i
+          if j == dst: return parent
+          next_frontier.append(j)
+      frontier = next_frontier
+    return parent
+
+  def _trace_path (self, parent, src, dst):
+    """
+    Follows the BFS parents back from dst and returns the DPID path
+    """
+    dpids = self._dpids
+    path = [dpids[dst]]
+    while dst != src:
+      dst = parent[dst]
+      path.append(dpids[dst])
+    path.reverse()
+    return path
+
+  def _rebuild_paths (self):
+    """
+    Recompute the whole path table for the current topology version
+    """
+    self._paths.clear()
+    self._paths_by_hop.clear()
+    dpids = self._dpids
+    for src in range(len(dpids)):
+      parent = self._bfs(src)
+      for dst, p in enumerate(parent):
+        if p == -1: continue
+        self._store_path(dpids[src], dpids[dst],
+                         self._trace_path(parent, src, dst))
+    self._paths_complete = True
+    log.debug("Rebuilt path table for topology version %s (%s paths)",
+              self.topology_version, len(self._paths))
+
+  def _store_path (self, src, dst, path):
+    self._paths[src, dst] = path
+    for hop in zip(path, path[1:]):
+      self._paths_by_hop[hop].add((src, dst))
+
+  def _lookup_path (self, src, dst):
+    """
+    Returns the cached shortest path from src to dst (or None)
+    """
+    if not self._paths_complete:
+      self._rebuild_paths()
+    path = self._paths.get((src, dst))
+    if path is not None: return path
+    # Either there's no path or it was dropped by a link removal
+    i = self._ids.get(src)
+    j = self._ids.get(dst)
+    if i is None or j is None: return None
+    parent = self._bfs(i, j)
+    if parent[j] == -1: return None
+    path = self._trace_path(parent, i, j)
+    self._store_path(src, dst, path)
+    return path
+
+  def _add_live_hop (self, dpid1, port1, dpid2):
+    i = self._node_id(dpid1)
+    j = self._node_id(dpid2)
+    ports = self._ports.get((i, j))
+    if ports:
+      # Parallel link (or one to another port of dpid2, e.g. while the
+      # cable's old link hasn't timed out); paths over this hop are
+      # unaffected
+      ports[port1] = ports.get(port1, 0) + 1
+      return
+    self._ports[i, j] = {port1: 1}
+    self._adj[i].append(j)
+    # A new hop can shorten any path, so rebuild on next lookup
+    self.topology_version += 1
+    self._paths_complete = False
+
+  def _remove_live_hop (self, dpid1, port1, dpid2):
+    i = self._ids.get(dpid1)
+    j = self._ids.get(dpid2)
+    if i is None or j is None: return
+    ports = self._ports.get((i, j))
+    if not ports or port1 not in ports: return
+    ports[port1] -= 1
+    if ports[port1] == 0: del ports[port1]
+    if ports: return
+    del self._ports[i, j]
+    self._adj[i].remove(j)
+    self.topology_version += 1
+    # Only the paths going over this hop are invalid now; they get
+    # recomputed one by one when asked for
+    for key in self._paths_by_hop.pop((dpid1, dpid2), ()):
+      path = self._paths.pop(key, None)
+      if path is None: continue
+      for hop in zip(path, path[1:]):
+        self._paths_by_hop.get(hop, set()).discard(key)
 
   def _handle_openflow_discovery_LinkEvent (self, event):
     l = event.link
@@ -581,6 +878,52 @@ class DiscoveryGraph (EventMixin):
 
     self._do_auto_export()
 
+  def _handle_openflow_discovery_TopologyDelta (self, event):
+    """
+    Apply discovery's link changes to the routing graph
+
+    Changes come in batches when discovery coalesces them, so the path
+    table is only invalidated once per batch.
+    """
+    if event.version != self._delta_version + 1:
+      log.debug("Topology deltas missed (%s -> %s), resyncing",
+                self._delta_version, event.version)
+      self._delta_version = event.version
+      self._resync_live()
+      return
+    self._delta_version = event.version
+    for l in event.removed:
+      self._remove_live_link(l)
+    for l in event.added:
+      self._add_live_link(l)
+
+  def _add_live_link (self, link):
+    # After a resync, changes still on their way may already be applied
+    if link in self._live_links: return
+    self._live_links.add(link)
+    self._add_live_hop(link.dpid1, link.port1, link.dpid2)
+
+  def _remove_live_link (self, link):
+    if link not in self._live_links: return
+    self._live_links.discard(link)
+    self._remove_live_hop(link.dpid1, link.port1, link.dpid2)
+
+  def _resync_live (self):
+    """
+    Rebuild the routing graph from discovery's current links
+    """
+    self._ids.clear()
+    del self._dpids[:]
+    del self._adj[:]
+    self._ports.clear()
+    self._live_links.clear()
+    self._paths.clear()
+    self._paths_by_hop.clear()
+    self._paths_complete = False
+    self.topology_version += 1
+    for l in core.openflow_discovery.adjacency:
+      self._add_live_link(l)
+
   def _handle_openflow_PortStatus (self, event):
     self._do_auto_export()
 
@@ -648,7 +991,11 @@ def graph (export = None, dpids_only = False, interval = "2.0"):
 
 
 def launch (no_flow = False, explicit_drop = True, link_timeout = None,
-            eat_early_packets = False):
+            eat_early_packets = False, coalesce = 0):
+  """
+  --coalesce=seconds raises the link changes within that time as one
+  TopologyDelta (they're raised right away by default)
+  """
   explicit_drop = str_to_bool(explicit_drop)
   eat_early_packets = str_to_bool(eat_early_packets)
   install_flow = not str_to_bool(no_flow)
@@ -656,5 +1003,6 @@ def launch (no_flow = False, explicit_drop = True, link_timeout = None,
 
   core.registerNew(Discovery, explicit_drop=explicit_drop,
                    install_flow=install_flow, link_timeout=link_timeout,
-                   eat_early_packets=eat_early_packets)
+                   eat_early_packets=eat_early_packets,
+                   coalesce=float(coalesce))
   core.registerNew(DiscoveryGraph)
@@ -1,65 +1,1168 @@
 from pox.core import core
 from pox.lib.packet import ethernet, ipv4, tcp, arp
-from pox.lib.addresses import EthAddr, IPAddr
+from pox.lib.addresses import EthAddr, IPAddr, parse_cidr, IP_ANY, ETHER_ANY, ETHER_BROADCAST
 import pox.openflow.libopenflow_01 as of
-from collections import defaultdict
-from pox.lib.util import str_to_dpid, dpid_to_str
-from pox.lib.revent import Event, EventMixin
-from time import sleep
+from collections import defaultdict, deque, OrderedDict
+from array import array
+from pox.lib.util import dpid_to_str, str_to_bool
+from pox.lib.revent import EventMixin
+from pox.lib.recoco import Timer
+from time import sleep, time, perf_counter
+import heapq
+import json
+import os
+import random
+import struct
 import threading
+import zlib
 import logging
 import inspect
 
 
 log = core.getLogger()
 
-ZERO_DPID = "00-00-00-00-00-0"
-MAC_ZERO = "00:00:00:00:00:0"
-
 #flow entry timeouts
 IDLE_TIMEOUT = 2
 HARD_TIMEOUT = 5
 
+#limits of the adaptive timeout policy, and the rate (bytes/s) above which
+#a connection counts as high-volume
+MAX_IDLE_TIMEOUT = 10
+MAX_HARD_TIMEOUT = 60
+HIGH_RATE = 100000
+
 #interval between requesting from OVS'es connections stats 
 REQUEST_FOR_STATS_INTERVAL = 1
 
-class RequestPathEvent(Event):
-        def __init__(self, dpid1, dpid2):
-            Event.__init__(self)
-            self.path_endpoints = (dpid1, dpid2)
+#how long a just assigned connection is counted before stats have to show it
+PENDING_TIMEOUT = 3
+
+#connections keep their server while they come back to the controller at
+#least this often (must be longer than MAX_HARD_TIMEOUT)
+AFFINITY_IDLE_TIMEOUT = 90
+#max number of connections remembered
+AFFINITY_MAX_ENTRIES = 100000
+
+#interval between reconciling FlowRemoved based counts with connections stats
+RECONCILE_INTERVAL = 10
+
+#cookie of the flow entries installed by the LB
+LB_COOKIE = 0x1c1a
+
+#cookie of the flow entries counted as connections by the FlowRemoved tracker
+CONNECTION_COOKIE = 0x1c1b
+
+#flow table the LB installs its entries in
+LB_TABLE = 0
+
+#what is asked from switches for connections stats:
+#  flow      - whole flow tables of the backends' switches
+#  filtered  - LB's flows toward each backend, from the backend's switch
+#  aggregate - number of LB's flows toward each backend, from the backend's switch
+STATS_MODES = ('flow', 'filtered', 'aggregate')
+
+#proactive mode: priority of its rules (partitions and rewrites go one
+#above), cookie of the partition rules, interval between rebalancing runs
+#and the relative load difference of servers which makes a partition move
+PROACTIVE_PRIORITY = 0x7000
+PARTITION_COOKIE = 0x1c1c
+REBALANCE_INTERVAL = 5
+REBALANCE_THRESHOLD = 0.5
+
+#server selection policies:
+#  least_connections - fewest connections
+#  weighted          - fewest connections per capacity weight (--weights)
+#  least_bandwidth   - lowest EWMA throughput from flow byte counters
+#  maglev            - consistent hash of the connection (see MaglevTable)
+POLICIES = ('least_connections', 'weighted', 'least_bandwidth', 'maglev')
+
+#maglev policy: size of the lookup table (a prime, much larger than the
+#number of servers) and the relative change of a server's weight (from
+#its connections against the average) which makes the table rebuilt
+MAGLEV_TABLE_SIZE = 5003
+MAGLEV_REWEIGHT_THRESHOLD = 0.25
+
+#number of servers sampled per selection (d-choices), the least loaded of
+#them gets the connection; 0 compares all servers (strict least)
+CHOICES = 0
+
+#smoothing of the throughput EWMA (weight of the newest stats round)
+EWMA_ALPHA = 0.3
+
+#ARP requests for the VIPs are trapped to the controller by rules of this
+#priority and cookie; replies are cached packed, at most this many
+ARP_TRAP_PRIORITY = 0x7100
+ARP_COOKIE = 0x1c1d
+ARP_CACHE_MAX_ENTRIES = 10000
+
+#min interval between ARP probes of a host whose location is unknown
+PROBE_INTERVAL = 1
+
+#max time to wait for barrier replies before releasing a packet anyway
+BARRIER_TIMEOUT = 0.5
+
+class PathInstall(object):
+    """
+    A path whose flow mods were sent and which waits for barrier replies.
+    """
+    def __init__(self, key, event, ingress):
+        self.key = key              # connection key of the packet
+        self.event = event          # PacketIn which triggered the install
+        self.ingress = ingress      # (dpid, flow_mod) sent last
+        self.barriers = set()       # xids of barriers still not replied
+        self.waiting = []           # PacketIns of the same connection meanwhile
+        self.done = False
+
+class FlowTemplate(object):
+    """
+    A flow mod packed once, with its actions, for TemplateFlow to patch.
+    """
+    def __init__(self, actions):
+        self.actions = actions
+        self.packed = of.ofp_flow_mod(cookie=LB_COOKIE, actions=actions).pack()
+
+class TemplateFlow(object):
+    """
+    A flow mod of the LB made from a FlowTemplate and a packed match.
+
+    Packing copies the template's bytes and patches in a new xid, the
+    match (plus dl_dst/nw_dst of the hop, when given), cookie, timeouts,
+    buffer id and flags at their OpenFlow 1.0 offsets.
+    """
+    __slots__ = ('template', 'match', 'dl_dst', 'nw_dst', 'idle_timeout', 'hard_timeout',
+                 'cookie', 'flags', 'buffer_id')
+
+    # cookie, command, idle/hard timeout, priority, buffer id, out port, flags
+    _fields = struct.Struct('!QHHHHIHH')
+    _xid = struct.Struct('!I')
+
+    def __init__(self, template, match, dl_dst=None, nw_dst=None,
+                 timeouts=(IDLE_TIMEOUT, HARD_TIMEOUT)):
+        self.template = template
+        self.match = match          # packed ofp_match, 40 bytes
+        self.dl_dst = dl_dst        # raw bytes replacing the match's, if any
+        self.nw_dst = nw_dst
+        self.idle_timeout, self.hard_timeout = timeouts
+        self.cookie = LB_COOKIE
+        self.flags = 0
+        self.buffer_id = None
+
+    @property
+    def actions(self):
+        return self.template.actions
+
+    def pack(self):
+        data = bytearray(self.template.packed)
+        # the template's xid was taken when it was packed, errors of the
+        # switch must point at this flow mod
+        self._xid.pack_into(data, 4, of.generate_xid())
+        data[8:48] = self.match
+        if self.dl_dst is not None:
+            data[20:26] = self.dl_dst
+        if self.nw_dst is not None:
+            data[40:44] = self.nw_dst
+        buffer_id = of.NO_BUFFER if self.buffer_id is None else self.buffer_id
+        self._fields.pack_into(data, 48, self.cookie, of.OFPFC_ADD, self.idle_timeout,
+                               self.hard_timeout, of.OFP_DEFAULT_PRIORITY, buffer_id,
+                               of.OFPP_NONE, self.flags)
+        return bytes(data)
+
+class FlowTemplates(object):
+    """
+    Pre-packed flow mods of the LB, one per output port and rewrite.
+
+    The flow mods of a path only differ in a few match fields, so they are
+    packed once and then stamped with each connection's match (see
+    TemplateFlow) instead of being built and packed from objects per hop.
+    """
+    def __init__(self):
+        self._templates = {}  # (direction, out port, rewritten addresses): FlowTemplate
+
+    @staticmethod
+    def pack_match(match):
+        """
+        Pack the match flows of a connection start from.
+        """
+        match = match.clone()
+        match.nw_proto = None
+        return match.pack()
+
+    def forward(self, out_port, dst_mac, dst_ip, match, timeouts=(IDLE_TIMEOUT, HARD_TIMEOUT)):
+        template = self._templates.get(('forward', out_port))
+        if template is None:
+            template = self._templates['forward', out_port] = FlowTemplate(
+                [of.ofp_action_output(port=out_port)])
+        return TemplateFlow(template, match, dst_mac.toRaw(), dst_ip.toRaw(), timeouts)
+
+    def to_server(self, out_port, server_mac, server, match, service,
+                  timeouts=(IDLE_TIMEOUT, HARD_TIMEOUT)):
+        key = ('to_server', out_port, server_mac, server)
+        template = self._templates.get(key)
+        if template is None:
+            template = self._templates[key] = FlowTemplate([
+                of.ofp_action_dl_addr.set_dst(server_mac),
+                of.ofp_action_nw_addr.set_dst(server),
+                of.ofp_action_output(port=out_port)])
+        return TemplateFlow(template, match, service.mac.toRaw(), service.vip.toRaw(), timeouts)
+
+    def to_client(self, out_port, match, service, timeouts=(IDLE_TIMEOUT, HARD_TIMEOUT)):
+        key = ('to_client', out_port, service.mac, service.vip)
+        template = self._templates.get(key)
+        if template is None:
+            template = self._templates[key] = FlowTemplate([
+                of.ofp_action_dl_addr.set_src(service.mac),
+                of.ofp_action_nw_addr.set_src(service.vip),
+                of.ofp_action_output(port=out_port)])
+        return TemplateFlow(template, match, timeouts=timeouts)
+
+    def __len__(self):
+        return len(self._templates)
+
+class ServerPool(object):
+    """
+    Connection counts of the backend servers, indexed for least-count lookup.
+
+    Kept as an indexed binary min-heap: changing a server's count is
+    O(log n) and finding the least loaded server is O(1). Servers are
+    ranked by count / weight (weights default to 1), ties go to the server
+    added first. Reads like a dict of server ip: count, total is the sum of
+    the counts.
+    """
+    def __init__(self, servers=(), weights=None):
+        self._heap = []  # [count / weight, order, server, count] entries
+        self.total = 0
+        self._index = {}  # server ip: position of its entry in _heap
+        self._weights = dict(weights or {})  # server ip: capacity weight
+        self._next_order = 0
+        for server in servers:
+            self.add_server(server)
+
+    def add_server(self, server, count=0):
+        if server in self._index:
+            self.set(server, count)
+            return
+        self._heap.append([count / self.weight(server), self._next_order, server, count])
+        self.total += count
+        self._next_order += 1
+        self._index[server] = len(self._heap) - 1
+        self._sift_up(len(self._heap) - 1)
+
+    def remove_server(self, server):
+        pos = self._index.pop(server)
+        self.total -= self._heap[pos][3]
+        last = self._heap.pop()
+        if pos < len(self._heap):
+            self._heap[pos] = last
+            self._index[last[2]] = pos
+            self._sift_down(pos)
+            self._sift_up(pos)
+
+    def select(self):
+        """
+        Return the server with the least connections (None if empty).
+        """
+        return self._heap[0][2] if self._heap else None
+
+    def select_sampled(self, d):
+        """
+        Return the least loaded of d servers sampled at random (None if empty).
+
+        Costs O(d) whatever the number of servers, and keeps balance when
+        counts are stale, as not every selection goes to the same server.
+        """
+        if d <= 0 or d >= len(self._heap):
+            return self.select()
+        # sampled with replacement, as the analysis of d-choices assumes
+        n = len(self._heap)
+        best = self._heap[int(random.random() * n)]
+        for _ in range(d - 1):
+            entry = self._heap[int(random.random() * n)]
+            if self._less(entry, best):
+                best = entry
+        return best[2]
+
+    def weight(self, server):
+        return self._weights.get(server, 1)
+
+    def set_weight(self, server, weight):
+        self._weights[server] = weight
+        if server in self._index:
+            self.set(server, self[server])
+
+    def set(self, server, count):
+        pos = self._index[server]
+        entry = self._heap[pos]
+        old = entry[0]
+        entry[0] = count / self.weight(server)
+        self.total += count - entry[3]
+        entry[3] = count
+        if entry[0] < old:
+            self._sift_up(pos)
+        elif entry[0] > old:
+            self._sift_down(pos)
+
+    def add(self, server, delta):
+        """
+        Change a server's count by delta, never going below zero.
+        """
+        self.set(server, max(0, self[server] + delta))
+
+    def __getitem__(self, server):
+        return self._heap[self._index[server]][3]
+
+    def __contains__(self, server):
+        return server in self._index
+
+    def __iter__(self):
+        return iter(list(self._index))
+
+    def __len__(self):
+        return len(self._heap)
+
+    def items(self):
+        return [(server, self._heap[pos][3]) for server, pos in list(self._index.items())]
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def _less(self, a, b):
+        return (a[0], a[1]) < (b[0], b[1])
+
+    def _swap(self, i, j):
+        heap = self._heap
+        heap[i], heap[j] = heap[j], heap[i]
+        self._index[heap[i][2]] = i
+        self._index[heap[j][2]] = j
+
+    def _sift_up(self, pos):
+        heap = self._heap
+        while pos > 0:
+            parent = (pos - 1) >> 1
+            if not self._less(heap[pos], heap[parent]):
+                break
+            self._swap(pos, parent)
+            pos = parent
+
+    def _sift_down(self, pos):
+        heap = self._heap
+        size = len(heap)
+        while True:
+            child = 2 * pos + 1
+            if child >= size:
+                break
+            if child + 1 < size and self._less(heap[child + 1], heap[child]):
+                child += 1
+            if not self._less(heap[child], heap[pos]):
+                break
+            self._swap(pos, child)
+            pos = child
+
+class MaglevTable(object):
+    """
+    Maglev lookup table mapping connections to servers by their hash.
+
+    Every server fills the table slots in the order of its own permutation
+    of them, taking turns in proportion to its weight. Hashes are crc32,
+    so the table only depends on the servers and weights (not on the
+    controller's run), and adding or removing a server moves only about
+    the slots it takes or gives up.
+    """
+    def __init__(self, servers=(), weights=None, size=MAGLEV_TABLE_SIZE):
+        self.size = size
+        self.weights = {}  # server ip: weight the table was built with
+        self.table = []  # slot: server ip
+        self.build(servers, weights)
+
+    def build(self, servers, weights=None):
+        """
+        (Re)build the table for the given servers (weights default to 1).
+        """
+        weights = weights or {}
+        self.weights = {server: weights.get(server, 1) for server in servers}
+        servers = sorted((s for s, w in self.weights.items() if w > 0), key=str)
+        if not servers:
+            self.table = []
+            return
+        size = self.size
+        offsets, skips = [], []
+        for server in servers:
+            name = str(server).encode()
+            offsets.append(zlib.crc32(b'offset' + name) % size)
+            skips.append(zlib.crc32(b'skip' + name) % (size - 1) + 1)
+        top = max(self.weights[server] for server in servers)
+        share = [self.weights[server] / top for server in servers]
+        credit = [0.0] * len(servers)
+        tried = [0] * len(servers)  # position in each server's permutation
+        table = [None] * size
+        filled = 0
+        while filled < size:
+            for i, server in enumerate(servers):
+                credit[i] += share[i]
+                if credit[i] < 1:
+                    continue
+                credit[i] -= 1
+                slot = (offsets[i] + tried[i] * skips[i]) % size
+                while table[slot] is not None:
+                    tried[i] += 1
+                    slot = (offsets[i] + tried[i] * skips[i]) % size
+                table[slot] = server
+                tried[i] += 1
+                filled += 1
+                if filled == size:
+                    break
+        self.table = table
+
+    def lookup(self, key):
+        """
+        Return the server of a (src ip, dst ip, protocol, src port, dst port)
+        connection key (None if there are no servers).
+        """
+        if not self.table:
+            return None
+        src, dst, protocol, srcport, dstport = key
+        data = struct.pack('!IIBHH', src.toUnsigned(), dst.toUnsigned(), protocol,
+                           srcport or 0, dstport or 0)
+        return self.table[zlib.crc32(data) % self.size]
+
+class AffinityTable(object):
+    """
+    Connection key -> backend server, for connections seen recently.
+
+    Entries are kept in last-use order, so idle ones are evicted from the
+    front in O(1) each, and the table never holds more than max_entries.
+    """
+    def __init__(self, idle_timeout, max_entries):
+        self.idle_timeout = idle_timeout
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key: (server, last use time)
+
+    def get(self, key, now=None):
+        """
+        Return the server of a connection (None if unknown) and mark it used.
+        """
+        if now is None: now = time()
+        self._evict(now)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries[key] = (entry[0], now)
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, server, now=None):
+        if now is None: now = time()
+        self._entries[key] = (server, now)
+        self._entries.move_to_end(key)
+        self._evict(now)
+
+    def discard(self, key):
+        self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _evict(self, now):
+        entries = self._entries
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+        before = now - self.idle_timeout
+        while entries:
+            key, (server, used) = next(iter(entries.items()))
+            if used >= before:
+                break
+            entries.popitem(last=False)
+
+class TimedConnection(object):
+    """
+    Age and rate of a connection, as seen by the timeout policies.
+    """
+    __slots__ = ('first_seen', 'last_seen', 'rate', 'fixed_reinstalls')
+
+    def __init__(self, now):
+        self.first_seen = now
+        self.last_seen = now
+        self.rate = 0.0  # bytes per second, from flow stats
+        self.fixed_reinstalls = 0
+
+
+class TimeoutPolicy(object):
+    """
+    Flow timeouts of connections: IDLE_TIMEOUT and HARD_TIMEOUT for all.
+
+    Also keeps every connection's age and rate, and counts reinstalls
+    next to how many fixed timeouts would have needed, to compare policies.
+    """
+    name = 'fixed'
+
+    def __init__(self):
+        self._connections = {}  # (client ip, client port, service port): TimedConnection
+        self.installs = 0
+        self.reinstalls = 0
+        self.fixed_reinstalls = 0  # reinstalls fixed timeouts would have needed
+
+    def timeouts(self, pkey, now):
+        """
+        Return the (idle, hard) timeouts for a connection's flows.
+        """
+        return IDLE_TIMEOUT, HARD_TIMEOUT
+
+    def installed(self, pkey, now):
+        self.installs += 1
+        conn = self._connections.get(pkey)
+        if conn is None:
+            self._connections[pkey] = TimedConnection(now)
+            return
+        self.reinstalls += 1
+        conn.last_seen = now
+        self._estimate(conn, now)
+
+    def observe(self, pkey, byte_count, duration, now):
+        """
+        Update a connection from the flow stats of its flow.
+        """
+        conn = self._connections.get(pkey)
+        if conn is None:
+            return
+        conn.last_seen = now
+        conn.rate = byte_count / max(duration, 1)
+        self._estimate(conn, now)
+
+    def expire(self, before):
+        for pkey in [k for k, c in self._connections.items() if c.last_seen < before]:
+            del self._connections[pkey]
+
+    def _estimate(self, conn, now):
+        # with fixed timeouts a connection comes back every HARD_TIMEOUT
+        estimate = int((now - conn.first_seen) // HARD_TIMEOUT)
+        self.fixed_reinstalls += estimate - conn.fixed_reinstalls
+        conn.fixed_reinstalls = estimate
+
+
+class AdaptiveTimeoutPolicy(TimeoutPolicy):
+    """
+    Flow timeouts growing with a connection's age and rate.
+
+    A connection which has lived for some time likely lives on, so its hard
+    timeout follows its age (up to MAX_HARD_TIMEOUT). Connections faster
+    than HIGH_RATE get it doubled and a longer idle timeout. New connections
+    get the fixed timeouts.
+    """
+    name = 'adaptive'
+
+    def timeouts(self, pkey, now):
+        conn = self._connections.get(pkey)
+        if conn is None:
+            return IDLE_TIMEOUT, HARD_TIMEOUT
+        hard = max(HARD_TIMEOUT, int(now - conn.first_seen))
+        idle = IDLE_TIMEOUT
+        if conn.rate >= HIGH_RATE:
+            hard *= 2
+            idle = MAX_IDLE_TIMEOUT
+        return idle, min(hard, MAX_HARD_TIMEOUT)
+
+
+TIMEOUT_POLICIES = {policy.name: policy for policy in (TimeoutPolicy, AdaptiveTimeoutPolicy)}
+
+
+class HostTable(object):
+    """
+    Learned hosts: IP -> MAC and the (dpid, port) of the edge port they're on.
+
+    Kept in flat arrays with a slot per host (6 bytes of MAC, the dpid and
+    the port) and a dict from IP to slot, so thousands of hosts take little
+    memory. Slots of removed hosts are reused. Reads like a dict of
+    ip: (dpid, port).
+    """
+    def __init__(self):
+        self._slots = {}  # ip: slot
+        self._macs = bytearray()  # 6 bytes per slot
+        self._dpids = array('Q')
+        self._ports = array('H')
+        self._free = []  # slots of removed hosts
+
+    def learn(self, ip, mac, dpid, port):
+        """
+        Record where a host is, returns True if that's new.
+        """
+        raw = mac.toRaw()
+        slot = self._slots.get(ip)
+        if slot is None:
+            if not self._free:
+                self._slots[ip] = len(self._ports)
+                self._macs += raw
+                self._dpids.append(dpid)
+                self._ports.append(port)
+                return True
+            slot = self._free.pop()
+            self._slots[ip] = slot
+        elif self._dpids[slot] == dpid and self._ports[slot] == port \
+        and self._macs[slot * 6:slot * 6 + 6] == raw:
+            return False
+        self._macs[slot * 6:slot * 6 + 6] = raw
+        self._dpids[slot] = dpid
+        self._ports[slot] = port
+        return True
+
+    def remove(self, ip):
+        slot = self._slots.pop(ip, None)
+        if slot is not None:
+            self._free.append(slot)
+
+    def mac(self, ip):
+        """
+        Return the MAC of a host (None if unknown).
+        """
+        slot = self._slots.get(ip)
+        if slot is None:
+            return None
+        return EthAddr(bytes(self._macs[slot * 6:slot * 6 + 6]))
+
+    def get(self, ip, default=None):
+        slot = self._slots.get(ip)
+        if slot is None:
+            return default
+        return self._dpids[slot], self._ports[slot]
+
+    def __getitem__(self, ip):
+        slot = self._slots[ip]
+        return self._dpids[slot], self._ports[slot]
+
+    def __contains__(self, ip):
+        return ip in self._slots
+
+    def __iter__(self):
+        return iter(list(self._slots))
+
+    def __len__(self):
+        return len(self._slots)
+
+
+class Service(object):
+    """
+    A virtual service (a VIP, or one port of it) and its backend servers.
+
+    Keeps all the server selection state of the service: connection
+    counts, pending assignments, throughput and the maglev table, so the
+    services of one controller are balanced independently.
+    """
+    def __init__(self, vip, port=None, servers=(), mac=None, policy='least_connections',
+                 weights=None, choices=CHOICES):
+        self.vip = IPAddr(vip)
+        self.port = port
+        # VIP's MAC defaults to 0a and the VIP's last three bytes (0a:00:00:64:00:00
+        # for 10.0.0.100), locally administered and unicast
+        self.mac = EthAddr(mac) if mac else EthAddr(b'\x0a' + self.vip.toRaw()[1:] + b'\x00\x00')
+        self.policy = policy
+        self.choices = choices
+        self.weights = dict(weights or {})  # server ip: capacity weight
+        self.server_pool = ServerPool(servers, self.weights if policy == 'weighted' else None) # server ip: connections count
+        self.server_pool_tmp = dict.fromkeys(self.server_pool, 0) # counts of the round in progress
+        # Connections assigned but not yet seen by a complete stats round
+        self.pending = deque()  # (assignment time, server ip), oldest first
+        self.pending_counts = defaultdict(int)  # server ip: its entries in pending
+        self.round_delta = defaultdict(int)  # tracked count changes since the round started
+        # Throughput of the servers (bytes/s EWMA), from flow byte counters
+        self.throughput = ServerPool(self.server_pool)
+        self.flow_bytes = {}  # flow (or server in aggregate stats): byte count in the last round
+        self.flow_bytes_tmp = {}  # the same for the round in progress
+        self.server_bytes_tmp = defaultdict(int)  # server ip: bytes since the last round
+        self.throughput_sampled = None  # start of the round the EWMA was last updated from
+        self.throughput_ewma = {}  # server ip: EWMA without counted in new connections
+        # Consistent hash lookup table of the maglev policy
+        self.maglev = None
+        if policy == 'maglev':
+            self.maglev = MaglevTable(self.server_pool, self.weights)
+
+    def __repr__(self):
+        if self.port is None:
+            return str(self.vip)
+        return f"{self.vip}:{self.port}"
+
+    def add_server(self, server, weight=None):
+        if weight is not None:
+            self.weights[server] = weight
+            if self.policy == 'weighted':
+                self.server_pool.set_weight(server, weight)
+        if server not in self.server_pool:
+            self.server_pool.add_server(server)
+            self.throughput.add_server(server)
+            self.server_pool_tmp[server] = 0
+        if self.maglev is not None:
+            self.maglev.build(self.server_pool, self.weights)
+
+    def remove_server(self, server):
+        if server not in self.server_pool:
+            return
+        self.server_pool.remove_server(server)
+        self.throughput.remove_server(server)
+        self.server_pool_tmp.pop(server, None)
+        if self.pending_counts.pop(server, 0):
+            self.pending = deque(entry for entry in self.pending if entry[1] != server)
+        self.throughput_ewma.pop(server, None)
+        if self.maglev is not None:
+            self.maglev.build(self.server_pool, self.weights)
+
+    def select(self, key=None):
+        """
+        Select the server for a new connection (None if there are none).
+
+        With choices set only that many random servers are compared. The
+        maglev policy instead looks the connection key up in its table.
+        """
+        if self.maglev is not None:
+            return self.maglev.lookup(key)
+        pool = self.throughput if self.policy == 'least_bandwidth' else self.server_pool
+        if self.choices:
+            return pool.select_sampled(self.choices)
+        return pool.select()
+
+    def assigned(self, server, new_connection, tracked):
+        """
+        Count in a connection (re)installed toward a server.
+        """
+        if tracked:
+            # the tracked flow is installed (again), it is removed with a
+            # FlowRemoved each time as well
+            self.count_connection(server, 1)
+        elif new_connection:
+            self.pending.append((time(), server))
+            self.pending_counts[server] += 1
+            self.server_pool.add(server, 1)
+        if new_connection and self.policy == 'least_bandwidth':
+            # until the next round, so a burst doesn't all go to one server
+            self.throughput.add(server, self.connection_rate())
+
+    def connection_rate(self):
+        """
+        Return the throughput of an average connection, for counting in
+        new connections before stats show their real rate.
+        """
+        connections = self.server_pool.total
+        total = self.throughput.total
+        if connections <= 0 or total <= 0:
+            return 1.0
+        return total / connections
+
+    def drop_pending(self, before):
+        """
+        Drop pending connections assigned before the given time.
+
+        Only the expired entries are looked at, from the front of the FIFO.
+        """
+        pending = self.pending
+        while pending and pending[0][0] < before:
+            server = pending.popleft()[1]
+            self.pending_counts[server] -= 1
+            self.server_pool.add(server, -1)
+
+    def start_round(self):
+        self.server_pool_tmp = dict.fromkeys(self.server_pool, 0)
+        self.round_delta = defaultdict(int)
+        self.flow_bytes_tmp = {}
+        self.server_bytes_tmp = defaultdict(int)
+
+    def count(self, server, flows, key, byte_count, aggregate=False):
+        """
+        Count flows toward a server (key and byte_count of one flow, or of
+        the server's flows in aggregate stats) into the round in progress.
+        """
+        self.server_pool_tmp[server] += flows
+        self.flow_bytes_tmp[key] = byte_count
+        previous = self.flow_bytes.get(key, 0)
+        if aggregate:
+            # the total drops when flows expire, that's no new traffic
+            self.server_bytes_tmp[server] += max(byte_count - previous, 0)
+            return
+        # a new flow (or one whose counters started over) moved all of its bytes
+        if byte_count < previous:
+            previous = 0
+        self.server_bytes_tmp[server] += byte_count - previous
+
+    def end_round(self, started, tracked):
+        """
+        Take the counts of a complete round which started at started.
+        """
+        if tracked:
+            self.reconcile(self.server_pool_tmp)
+        else:
+            # the round's counts include connections assigned before it
+            self.drop_pending(started)
+            for server, count in self.server_pool_tmp.items():
+                self.server_pool.set(server, count + self.pending_counts.get(server, 0))
+        self.server_pool_tmp = dict.fromkeys(self.server_pool, 0)
+        self.update_throughput(started)
+        if self.maglev is not None:
+            self.reweight_maglev()
+
+    def reweight_maglev(self):
+        """
+        Rebuild the maglev table when the servers' connections call for
+        weights different enough from the ones it was built with.
+
+        A server's weight is its capacity weight scaled by the average
+        connections per capacity over its own (between a half and double),
+        so loaded servers get fewer slots. Connections already assigned
+        keep their server through the affinity table.
+        """
+        loads = {server: count / self.weights.get(server, 1)
+                 for server, count in self.server_pool.items()}
+        average = sum(loads.values()) / len(loads) if loads else 0
+        weights = {}
+        for server, load in loads.items():
+            scale = 1.0
+            if average:
+                scale = min(2.0, max(0.5, average / load)) if load else 2.0
+            weights[server] = self.weights.get(server, 1) * scale
+        current = self.maglev.weights
+        if any(abs(weight - current.get(server, 0)) > MAGLEV_REWEIGHT_THRESHOLD * current.get(server, 0)
+               for server, weight in weights.items()):
+            log.debug("Rebuilding maglev table of %s with weights %s", self, weights)
+            self.maglev.build(self.server_pool, weights)
+
+    def update_throughput(self, started):
+        """
+        Fold the bytes of a complete round into the servers' throughput EWMA.
+        """
+        self.flow_bytes, self.flow_bytes_tmp = self.flow_bytes_tmp, {}
+        elapsed = None
+        if self.throughput_sampled is not None:
+            elapsed = started - self.throughput_sampled
+        self.throughput_sampled = started
+        if not elapsed:
+            # first round only sets the byte counts to take deltas from
+            return
+        for server in self.throughput:
+            rate = self.server_bytes_tmp[server] / elapsed
+            ewma = EWMA_ALPHA * rate + (1 - EWMA_ALPHA) * self.throughput_ewma.get(server, 0.0)
+            self.throughput_ewma[server] = ewma
+            self.throughput.set(server, ewma)
+        # every rate was just set, start the running total over so float
+        # errors don't pile up
+        self.throughput.total = sum(self.throughput_ewma.get(server, 0.0)
+                                    for server in self.throughput)
+
+    def count_connection(self, server, delta):
+        """
+        Apply a change seen by the FlowRemoved tracker to the counts.
+        """
+        self.server_pool.add(server, delta)
+        self.round_delta[server] += delta
+
+    def reconcile(self, snapshot):
+        """
+        Correct the tracked counts with the counts of a complete stats round.
+
+        Changes tracked since the round started can't be in the snapshot yet,
+        so they are applied on top of it.
+        """
+        counts = {server: max(0, count + self.round_delta[server])
+                  for server, count in snapshot.items()}
+        if counts != dict(self.server_pool.items()):
+            log.debug("Reconciled connection counts of %s %s -> %s", self, self.server_pool, counts)
+        for server, count in counts.items():
+            self.server_pool.set(server, count)
+
+
+class PartitionBalancer(object):
+    """
+    Proactive mode: the client address space split among a service's servers.
+
+    The client network is cut into 2**partition_bits prefixes. Client edge
+    switches get a wildcard rule per prefix rewriting VIP traffic to the
+    prefix's server, and every switch gets routes toward the servers and
+    clients, so connections don't come to the controller at all.
+
+    Partitions are first dealt out by least-connection counts. Afterwards
+    the rebalancer measures the packets of each partition rule and moves
+    one partition per REBALANCE_INTERVAL from the busiest to the idlest
+    server when they drift apart by more than REBALANCE_THRESHOLD. Open
+    connections of a moved partition are reset.
+    """
+    def __init__(self, lb, service, client_net, partition_bits):
+        self.lb = lb
+        self.service = service
+        net, net_bits = parse_cidr(client_net)
+        bits = min(32, net_bits + partition_bits)
+        shift = 32 - bits
+        self.prefixes = [(IPAddr(net.toUnsigned() + (i << shift)), bits)
+                         for i in range(1 << (bits - net_bits))]
+        self._by_prefix = {ip: i for i, (ip, _) in enumerate(self.prefixes)}
+        self.assignment = []  # partition index: server ip
+        self.activity = [0] * len(self.prefixes)  # packets of each partition in the last interval
+        self._packets = {}  # (dpid, partition index): packet count of the rule
+        self._installed_version = None
+        self._stats_requests = {}  # xid: dpid
+        self._round_activity = None
+        Timer(REBALANCE_INTERVAL, self.run, recurring=True)
+
+    def invalidate(self):
+        """
+        Reinstall everything on the next run (e.g. a switch reconnected).
+        """
+        self._installed_version = None
+
+    def run(self):
+        if not core.hasComponent("openflow_discGraph"):
+            return
+        version = core.openflow_discGraph.topology_version
+        if version != self._installed_version:
+            if self.install():
+                self._installed_version = version
+            return
+        self._request_stats()
+
+    def _clients(self):
+        return [ip for ip in self.lb.hosts if ip not in self.lb.backends]
+
+    def _client_edges(self):
+        return set(self.lb.hosts[client][0] for client in self._clients())
+
+    def _port_toward(self, dpid, host):
+        """
+        Return the output port on dpid toward a host (None if no path).
+        """
+        if host not in self.lb.hosts:
+            return None
+        host_dpid, host_port = self.lb.hosts[host]
+        if dpid == host_dpid:
+            return host_port
+        path = self.lb._request_Path(dpid, host_dpid)
+        if not path or len(path) < 2:
+            return None
+        return core.openflow_discGraph.get_port(dpid, path[1])
+
+    def _assign(self):
+        """
+        Deal out the partitions, more of them to servers with fewer connections.
+        """
+        load = ServerPool(self.service.server_pool)
+        for server, count in self.service.server_pool.items():
+            load.set(server, count)
+        self.assignment = []
+        for _ in self.prefixes:
+            server = load.select()
+            self.assignment.append(server)
+            load.add(server, 1)
+
+    def install(self):
+        """
+        Install routes, return rewrites and partitions on every switch.
+
+        Returns False if some rule couldn't be built yet (missing path).
+        """
+        if len(self.assignment) != len(self.prefixes) \
+        or any(server not in self.service.server_pool for server in self.assignment):
+            self._assign()
+        complete = True
+        msgs = defaultdict(list)
+        clients = self._clients()
+        for dpid in list(self.lb.connections):
+            for host in self.lb.hosts:
+                if host in clients and self.lb.hosts[host][0] == dpid:
+                    continue  # the client's own edge rewrites instead
+                port = self._port_toward(dpid, host)
+                if port is None:
+                    complete = False
+                    continue
+                msgs[dpid].append(self._route(host, port))
+        for client in clients:
+            dpid, port = self.lb.hosts[client]
+            for server in self.service.server_pool:
+                msgs[dpid].append(self._return_rewrite(server, client, port))
+        for dpid in self._client_edges():
+            for idx in range(len(self.prefixes)):
+                msg = self._partition(dpid, idx)
+                if msg is None:
+                    complete = False
+                    continue
+                msgs[dpid].append(msg)
+        self._send(msgs)
+        self._packets.clear()
+        return complete
+
+    def _install_partition(self, idx):
+        msgs = defaultdict(list)
+        for dpid in self._client_edges():
+            msg = self._partition(dpid, idx)
+            if msg is not None:
+                msgs[dpid].append(msg)
+        self._send(msgs)
+
+    def _send(self, msgs):
+        for dpid, dpid_msgs in msgs.items():
+            connection = self.lb.get_switch_connection(dpid)
+            if connection is not None:
+                connection.send(b''.join(msg.pack() for msg in dpid_msgs))
+
+    def _flow_mod(self, priority, cookie=LB_COOKIE):
+        msg = of.ofp_flow_mod()
+        msg.cookie = cookie
+        msg.priority = priority
+        msg.match.dl_type = ethernet.IP_TYPE
+        return msg
+
+    def _route(self, host, port):
+        msg = self._flow_mod(PROACTIVE_PRIORITY)
+        msg.match.nw_dst = host
+        msg.actions.append(of.ofp_action_output(port=port))
+        return msg
+
+    def _return_rewrite(self, server, client, port):
+        msg = self._flow_mod(PROACTIVE_PRIORITY + 1)
+        msg.match.nw_src = server
+        msg.match.nw_dst = client
+        msg.actions.append(of.ofp_action_dl_addr.set_src(self.service.mac))
+        msg.actions.append(of.ofp_action_nw_addr.set_src(self.service.vip))
+        msg.actions.append(of.ofp_action_output(port=port))
+        return msg
+
+    def _partition(self, dpid, idx):
+        server = self.assignment[idx]
+        port = self._port_toward(dpid, server)
+        if port is None:
+            return None
+        msg = self._flow_mod(PROACTIVE_PRIORITY + 1, PARTITION_COOKIE)
+        msg.match.nw_dst = self.service.vip
+        msg.match.nw_src = self.prefixes[idx]
+        msg.actions.append(of.ofp_action_dl_addr.set_dst(self.lb.hosts.mac(server)))
+        msg.actions.append(of.ofp_action_nw_addr.set_dst(server))
+        msg.actions.append(of.ofp_action_output(port=port))
+        return msg
+
+    def _request_stats(self):
+        if self._stats_requests:
+            log.debug("Partition stats incomplete, skipping rebalance")
+        self._stats_requests = {}
+        self._round_activity = [0] * len(self.prefixes)
+        for dpid in self._client_edges():
+            connection = self.lb.get_switch_connection(dpid)
+            if connection is None:
+                continue
+            request = of.ofp_stats_request()
+            request.type = of.OFPST_FLOW
+            request.body = of.ofp_flow_stats_request(
+                match=of.ofp_match(dl_type=ethernet.IP_TYPE, nw_dst=self.service.vip),
+                table_id=LB_TABLE)
+            connection.send(request)
+            self._stats_requests[request.xid] = dpid
+
+    def handle_stats(self, event):
+        """
+        Take partition stats replies, returns False for any other reply.
+        """
+        dpid = self._stats_requests.pop(event.ofp[0].xid, None)
+        if dpid is None:
+            return False
+        for flow in event.stats:
+            if flow.cookie != PARTITION_COOKIE:
+                continue
+            idx = self._by_prefix.get(flow.match.nw_src)
+            if idx is None:
+                continue
+            packets = flow.packet_count - self._packets.get((dpid, idx), 0)
+            if packets < 0:
+                # rule was reinstalled, its counters started over
+                packets = flow.packet_count
+            self._packets[dpid, idx] = flow.packet_count
+            self._round_activity[idx] += packets
+        if not self._stats_requests:
+            self.activity = self._round_activity
+            self._rebalance()
+        return True
+
+    def _rebalance(self):
+        load = dict.fromkeys(self.service.server_pool, 0)
+        for idx, server in enumerate(self.assignment):
+            if server in load:
+                load[server] += self.activity[idx]
+        if len(load) < 2:
+            return
+        busiest = max(load, key=load.get)
+        idlest = min(load, key=load.get)
+        gap = load[busiest] - load[idlest]
+        if gap <= REBALANCE_THRESHOLD * load[busiest]:
+            return
+        # the partition evening the two out best, moving one which carries
+        # the whole gap (or more) would just turn the imbalance around
+        candidates = [idx for idx, server in enumerate(self.assignment)
+                      if server == busiest and 0 < self.activity[idx] < gap]
+        if not candidates:
+            return
+        idx = min(candidates, key=lambda i: abs(self.activity[i] - gap / 2))
+        log.info("Moving partition %s/%s from %s to %s", self.prefixes[idx][0],
+                 self.prefixes[idx][1], busiest, idlest)
+        self.assignment[idx] = idlest
+        self._install_partition(idx)
+
 
 class LeastConnectionLB(EventMixin):
-    _eventMixin_events = set([RequestPathEvent])  # Register events
     logging.getLogger("libopenflow_01").setLevel(logging.ERROR)
 
-    def __init__(self):
+    def __init__(self, install_reverse=False, track_flow_removed=False, stats_mode='flow',
+                 timeout_policy='fixed', proactive=False, client_net='10.0.0.0/24',
+                 partition_bits=8, policy='least_connections', weights=None, choices=CHOICES,
+                 services_file=None):
         # Initialize EventMixin first
         EventMixin.__init__(self)
 
         self._core_name = 'misc_lclb'
 
-        # Server pool configuration
-        self.server_pool = {IPAddr(f'10.0.0.{i}'):0 for i in range(1,5)} # server ip: connections count
-        self.server_pool_tmp = {IPAddr(f'10.0.0.{i}'):0 for i in range(1,5)}
-        
+        # Install the server -> client path together with the client -> server
+        # one instead of waiting for the server's first reply
+        self.install_reverse = install_reverse
+
+        # Count connections as their flows are installed and removed, and use
+        # the stats rounds only to reconcile the counts
+        self.track_flow_removed = track_flow_removed
+        if track_flow_removed:
+            self.stats_interval = RECONCILE_INTERVAL
+        else:
+            self.stats_interval = REQUEST_FOR_STATS_INTERVAL
+        self.stats_mode = stats_mode
+        self.timeout_policy = TIMEOUT_POLICIES[timeout_policy]()
+
+        # Server selection defaults of the services
+        self.policy = policy
+        self.choices = choices
+        self.weights = weights or {}  # server ip: capacity weight
+
+        self.connections = {}  # Dictionary to store switch connections
+        self._arp_replies = OrderedDict()  # (ip, mac, requester mac, requester ip, port): packet_out bytes
+
         # Virtual service configuration
-        self.virtual_ip = IPAddr('10.0.0.100')
-        self.virtual_mac = EthAddr('0a:00:00:64:00:00')
-        # Connection tracking
-        self.connection_counts = defaultdict(int)  # Active connections per server
-        self.paths = dict()  # Store computed paths
+        self.services = {}  # (vip, port or None): Service
+        self.vips = {}  # vip: mac, of every service
+        self.backends = defaultdict(list)  # server ip: services it serves
+        self.services_file = services_file
+        self.services_mtime = None
+        if services_file:
+            self.load_services(services_file)
+        else:
+            self.add_service('10.0.0.100', servers=[IPAddr(f'10.0.0.{i}') for i in range(1,5)])
         # Network topology mapping
-        self.host_port_map = {
-            IPAddr("10.0.0.1"): (str_to_dpid(ZERO_DPID+"1"), 3),
-            IPAddr("10.0.0.2"): (str_to_dpid(ZERO_DPID+"1"), 4),
-            IPAddr("10.0.0.3"): (str_to_dpid(ZERO_DPID+"3"), 3),
-            IPAddr("10.0.0.4"): (str_to_dpid(ZERO_DPID+"3"), 4),
-            IPAddr("10.0.0.5"): (str_to_dpid(ZERO_DPID+"5"), 2),
-            IPAddr("10.0.0.6"): (str_to_dpid(ZERO_DPID+"5"), 3),
-            IPAddr("10.0.0.7"): (str_to_dpid(ZERO_DPID+"6"), 2),
-            IPAddr("10.0.0.8"): (str_to_dpid(ZERO_DPID+"6"), 3)
-        }
-        self.stats_from = []
+        self.hosts = HostTable()  # learned from PacketIns at edge ports
+        self._probed = {}  # ip: time of the last ARP probe
+        # Stats rounds
+        self.stats_round = 0
+        self.stats_requests = {}  # xid: (dpid, server) of requests still not replied in this round
+        self.stats_from = []  # dpids which replied in this round
+        self.stats_round_started = 0.0
+        # Server of each recent connection, so reinstalls keep it
+        self.affinity = AffinityTable(AFFINITY_IDLE_TIMEOUT, AFFINITY_MAX_ENTRIES)
+        # Service of each recent connection by its server side, (client ip,
+        # client port, server, server port), for the server's replies
+        self.reply_services = AffinityTable(AFFINITY_IDLE_TIMEOUT, AFFINITY_MAX_ENTRIES)
+        # Server of each tracked connection whose counted flow matches the
+        # VIP (client on the server's switch), by (client ip, client port,
+        # vip, port), for its FlowRemoved
+        self.tracked_rewrites = AffinityTable(AFFINITY_IDLE_TIMEOUT, AFFINITY_MAX_ENTRIES)
+        # Path installation pipeline
+        self._installing = {}  # connection key: PathInstall
+        self._pending_barriers = {}  # barrier xid: PathInstall
+        self.flow_templates = FlowTemplates()
+        # paths installed, packet outs held until barriers, PacketIns of
+        # connections being installed (each would have started another install)
+        self.install_counters = defaultdict(int)
         # Set up event listeners
         core.openflow.addListeners(self)  # Listen to OpenFlow events
         core.listen_to_dependencies(self)  # Listen to dependency events
@@ -71,23 +1174,16 @@ class LeastConnectionLB(EventMixin):
             # If discovery component isn't ready yet, wait for it
             core.call_when_ready(self._handle_discovery_ready, 
                                ["openflow_discovery"])
-        
-        if core.hasComponent("openflow_discGraph"):
-            self.listenTo(core.openflow_discGraph)
-        else:
-            # If discovery component isn't ready yet, wait for it
-            core.call_when_ready(self._handle_discGraph_ready, 
-                               ["openflow_discGraph"])
-
-        self.tmpPath = None
     
-        self.connections = {}  # Dictionary to store switch connections
-        core.openflow.addListeners(self)
-        self.flows = {IPAddr(f'10.0.0.{i}'):list() for i in range(1,5)}
-        # Hardcoded DPIDs (example values - replace with your actual DPIDs)
-        self.dpids = [1, 3]  # DPIDs as integers
         # Start the stats collection thread
         self.running = True
+        # Proactive partitioning of clients among servers
+        self.partitions = None
+        if proactive:
+            if len(self.services) != 1:
+                raise RuntimeError("Proactive mode balances a single service")
+            self.partitions = PartitionBalancer(self, next(iter(self.services.values())),
+                                                client_net, partition_bits)
         self.stats_thread = threading.Thread(target=self._stats_loop)
         self.stats_thread.daemon = True
         self.stats_thread.start()
@@ -97,6 +1193,13 @@ class LeastConnectionLB(EventMixin):
         """Store switch connection when it connects"""
         dpid = event.dpid
         self.connections[dpid] = event.connection
+        # ARP requests for the VIPs come to the controller instead of
+        # being flooded through the fabric
+        if self.vips:
+            event.connection.send(b''.join(self._arp_trap(vip).pack() for vip in self.vips))
+        if self.partitions is not None:
+            # a new or reconnected switch has none of the proactive rules
+            self.partitions.invalidate()
         #log.info(f"Switch {dpid_to_str(dpid)} connected")
         
     def _handle_ConnectionDown(self, event):
@@ -120,28 +1223,189 @@ class LeastConnectionLB(EventMixin):
             connection.send(message)
             return True
         return False
-    
-    def _handle_ResponsePathEvent(self, event):
-        #log.debug("ENTER: " + inspect.currentframe().f_code.co_name)
-        self.tmpPath = event.path
 
-    def _request_Path(self, dpid1, dpid2):
-        #log.debug("ENTER: " + inspect.currentframe().f_code.co_name)
-        self.raiseEvent(RequestPathEvent(dpid1, dpid2))
+    def add_service(self, vip, port=None, servers=(), mac=None, policy=None, weights=None,
+                    choices=None):
+        """
+        Add (or replace) the service of a VIP, or of one port of it.
 
-    def _handle_SendLink(self, event):
-        #log.debug("ENTER: " + inspect.currentframe().f_code.co_name)
-        if event.link.dpid1 not in self.paths:
-            self.paths[event.link.dpid1] = {event.link.dpid2: event.link.port1}
-        else:
-            self.paths[event.link.dpid1][event.link.dpid2] = event.link.port1
-        
-        if event.link.dpid2 not in self.paths:
-            self.paths[event.link.dpid2] = {event.link.dpid1: event.link.port2}
-        else:
-            self.paths[event.link.dpid2][event.link.dpid1] = event.link.port2
+        policy, weights and choices default to the ones given at launch.
+        Like the other service table changes, call it from the cooperative
+        thread (e.g. through core.callLater) when the LB is running.
+        """
+        vip = IPAddr(vip)
+        if policy is None: policy = self.policy
+        if weights is None: weights = self.weights
+        if choices is None: choices = self.choices
+        if (vip, port) in self.services:
+            self.remove_service(vip, port)
+        if mac is None and vip in self.vips:
+            # ports of a VIP share its MAC
+            mac = self.vips[vip]
+        service = Service(vip, port, [IPAddr(server) for server in servers], mac, policy,
+                          weights, choices)
+        self.services[vip, port] = service
+        if vip not in self.vips:
+            self._send_to_all(self._arp_trap(vip))
+        self.vips[vip] = service.mac
+        for server in service.server_pool:
+            self.backends[server].append(service)
+        log.info("Service %s: %s (%s)", service, ", ".join(map(str, service.server_pool)), policy)
+        return service
+
+    def remove_service(self, vip, port=None):
+        service = self.services.pop((IPAddr(vip), port), None)
+        if service is None:
+            return
+        for server in list(service.server_pool):
+            self._unlink_backend(server, service)
+        if not any(other.vip == service.vip for other in self.services.values()):
+            del self.vips[service.vip]
+            self._send_to_all(self._arp_trap(service.vip, of.OFPFC_DELETE_STRICT))
+        log.info("Service %s removed", service)
+
+    def add_server(self, vip, server, port=None, weight=None):
+        """
+        Add a server to a service (or change its weight).
+        """
+        service = self.services[IPAddr(vip), port]
+        server = IPAddr(server)
+        if server not in service.server_pool:
+            self.backends[server].append(service)
+        service.add_server(server, weight)
+
+    def remove_server(self, vip, server, port=None):
+        service = self.services[IPAddr(vip), port]
+        server = IPAddr(server)
+        if server in service.server_pool:
+            service.remove_server(server)
+            self._unlink_backend(server, service)
+
+    def _unlink_backend(self, server, service):
+        services = self.backends[server]
+        services.remove(service)
+        if not services:
+            del self.backends[server]
+
+    def _service(self, ip, port):
+        """
+        Return the service of a destination (None if it's not a VIP).
+        """
+        return self.services.get((ip, port)) or self.services.get((ip, None))
+
+    def _backend_services(self, server, port):
+        """
+        Return the services a server's connections on port belong to.
+        """
+        return [service for service in self.backends.get(server, ())
+                if service.port is None or service.port == port]
+
+    def _connection_service(self, client, client_port, server, port):
+        """
+        Return the service a client's connection to a server belongs to.
+
+        A server can be in several services, so it's looked up from the
+        connection. Without an entry the server's only service is taken,
+        None if it has none or several.
+        """
+        service = self.reply_services.get((client, client_port, server, port))
+        if service is not None and self.services.get((service.vip, service.port)) is service:
+            return service
+        services = self._backend_services(server, port)
+        if len(services) != 1:
+            return None
+        return services[0]
+
+    def load_services(self, path):
+        """
+        Make the service table what the config file says.
 
-        ##log.info(f"dpid1: {event.link.dpid1}, port1: {event.link.port1}, dpid2: {event.link.dpid2}, port2: {event.link.port2}")
+        The file is a JSON list of services like
+          {"vip": "10.0.0.100", "port": 80, "servers": ["10.0.0.1", "10.0.0.2"],
+           "mac": "0a:00:00:64:00:00", "policy": "weighted",
+           "weights": {"10.0.0.1": 2}, "choices": 2}
+        where only vip and servers are required. Services which stay keep
+        their counts, only their servers are added or removed.
+        """
+        entries = self._read_services(path)
+        self.services_mtime = os.path.getmtime(path)
+        wanted = {(entry['vip'], entry['port']): entry for entry in entries}
+        for key in list(self.services):
+            if key not in wanted:
+                self.remove_service(*key)
+        for key, entry in wanted.items():
+            service = self.services.get(key)
+            if service is None or service.policy != entry['policy'] \
+            or service.choices != entry['choices'] \
+            or (entry['mac'] is not None and service.mac != EthAddr(entry['mac'])):
+                self.add_service(**entry)
+                continue
+            for server in list(service.server_pool):
+                if server not in entry['servers']:
+                    self.remove_server(service.vip, server, service.port)
+            for server in entry['servers']:
+                self.add_server(service.vip, server, service.port, entry['weights'].get(server, 1))
+
+    def _read_services(self, path):
+        """
+        Read and check a services config file, see load_services.
+        """
+        with open(path) as f:
+            config = json.load(f)
+        entries = []
+        for item in config:
+            try:
+                entry = dict(vip=IPAddr(item['vip']), port=item.get('port'),
+                             servers=[IPAddr(server) for server in item['servers']],
+                             mac=item.get('mac'), policy=item.get('policy', self.policy),
+                             weights=dict(self.weights),
+                             choices=int(item.get('choices', self.choices)))
+                for server, weight in item.get('weights', {}).items():
+                    entry['weights'][IPAddr(server)] = float(weight)
+                if entry['port'] is not None:
+                    entry['port'] = int(entry['port'])
+                if entry['mac'] is not None:
+                    EthAddr(entry['mac'])
+            except (KeyError, TypeError, ValueError, RuntimeError) as e:
+                raise RuntimeError(f"Bad service {item!r} in {path}: {e}")
+            if entry['policy'] not in POLICIES:
+                raise RuntimeError(f"Unknown policy {entry['policy']} of service {item['vip']}")
+            if any(weight <= 0 for weight in entry['weights'].values()):
+                raise RuntimeError(f"Weights of service {item['vip']} have to be positive")
+            entries.append(entry)
+        return entries
+
+    def _check_services_file(self):
+        """
+        Reload the services config file if it changed.
+        """
+        if not self.services_file:
+            return
+        try:
+            mtime = os.path.getmtime(self.services_file)
+        except OSError:
+            return
+        if mtime == self.services_mtime:
+            return
+        try:
+            self.load_services(self.services_file)
+        except (OSError, ValueError, RuntimeError) as e:
+            log.error("Not reloading %s: %s", self.services_file, e)
+            self.services_mtime = mtime
+    
+    def _request_Path(self, dpid1, dpid2):
+        #log.debug("ENTER: " + inspect.currentframe().f_code.co_name)
+        """
+        Get the switch path between two DPIDs from the discovery graph.
+        """
+        if not core.hasComponent("openflow_discGraph"):
+            log.warning("Discovery graph is not running, no path available")
+            return None
+        path = core.openflow_discGraph.get_path(dpid1, dpid2)
+        if path is None:
+            log.warning("No path between %s and %s",
+                        dpid_to_str(dpid1), dpid_to_str(dpid2))
+        return path
 
     def _handle_PacketIn(self, event):
 
@@ -149,272 +1413,880 @@ class LeastConnectionLB(EventMixin):
         if not packet:
             return
 
+        self._learn_host(event, packet)
+
         # handle ARP packets
         if packet.type == ethernet.ARP_TYPE:
             arp_packet = packet.payload
             
             if arp_packet.opcode == arp.REQUEST:
-                if arp_packet.protodst == self.virtual_ip:
+                if arp_packet.protodst in self.vips:
                     ##log.info("Received ARP request for virtual IP")
-                    
-                    # Create ARP reply
-                    arp_reply = arp()
-                    arp_reply.hwsrc = self.virtual_mac
-                    arp_reply.hwdst = arp_packet.hwsrc
-                    arp_reply.opcode = arp.REPLY
-                    arp_reply.protosrc = self.virtual_ip
-                    arp_reply.protodst = arp_packet.protosrc
-                    
-                    # Create ethernet packet
-                    ether = ethernet()
-                    ether.type = ethernet.ARP_TYPE
-                    ether.dst = packet.src
-                    ether.src = self.virtual_mac
-                    ether.payload = arp_reply
-                    
-                    # Send packet out
-                    msg = of.ofp_packet_out()
-                    msg.data = ether.pack()
-                    msg.actions.append(of.ofp_action_output(port = event.port))
-                    event.connection.send(msg)
-                    
-                    ##log.info("Sent ARP reply: %s is at %s", self.virtual_ip, self.virtual_mac)
+                    event.connection.send(self._arp_reply(event, arp_packet, self.vips[arp_packet.protodst]))
+                    ##log.info("Sent ARP reply: %s is at %s", arp_packet.protodst, self.vips[arp_packet.protodst])
                 else:
-                    ethDst = EthAddr(MAC_ZERO+arp_packet.protodst.toStr()[-1])
-                    arp_reply = arp()
-                    arp_reply.hwsrc = ethDst        # MAC of real responder
-                    arp_reply.hwdst = arp_packet.hwsrc      # MAC of requester
-                    arp_reply.opcode = arp.REPLY
-                    arp_reply.protosrc = arp_packet.protodst # IP being requested
-                    arp_reply.protodst = arp_packet.protosrc # IP of requester
-                    
-                    # Create ethernet packet
-                    ether = ethernet()
-                    ether.type = ethernet.ARP_TYPE
-                    ether.dst = packet.src                   # Send to requester
-                    ether.src = ethDst                 # From responder
-                    ether.payload = arp_reply
-                    
-                    # Send packet out
-                    msg = of.ofp_packet_out()
-                    msg.data = ether.pack()
-                    msg.actions.append(of.ofp_action_output(port = event.port))
-                    event.connection.send(msg)
+                    ethDst = self.hosts.mac(arp_packet.protodst)
+                    if ethDst is None:
+                        # nobody knows yet, the host itself has to answer
+                        event.connection.send(self._packet_out(event, [of.ofp_action_output(port=of.OFPP_FLOOD)]))
+                        return
+                    event.connection.send(self._arp_reply(event, arp_packet, ethDst))
+            elif arp_packet.opcode == arp.REPLY and arp_packet.protodst not in self.vips:
+                # answer to a flooded request, replies to our probes were
+                # only needed for learning
+                self._deliver(event, arp_packet.protodst)
 
         # Process only IPv4 traffic
         if packet.type == ethernet.IP_TYPE :
             ip_packet = packet.find('ipv4')
             if ip_packet:
-                # Handle traffic directed to the virtual IP
-                if ip_packet.dstip == self.virtual_ip:
+                key = self._connection_key(ip_packet)
+                install = self._installing.get(key)
+                if install is not None:
+                    # path for this connection is on its way, don't start
+                    # another one, just release the packet afterwards
+                    install.waiting.append(event)
+                    self.install_counters['duplicate_packet_ins'] += 1
+                    return
+                # Handle traffic directed to a virtual IP
+                service = self._service(ip_packet.dstip, key[4])
+                if service is None and ip_packet.dstip in self.vips:
+                    # a VIP's port no service is configured for
+                    self._drop(event)
+                elif service is not None:
                     # when packet in comes from the client site
-                    selected_server = self._select_server()
+                    selected_server = self.affinity.get(key)
+                    new_connection = selected_server not in service.server_pool
+                    if new_connection:
+                        selected_server = self._select_server(service, key)
                     
                     if selected_server:
-                        self._redirect_to_server(event, ip_packet, selected_server)
-                else:
+                        self._redirect_to_server(event, ip_packet, service, selected_server, key,
+                                                 new_connection)
+                elif ip_packet.srcip in self.backends:
                     # when packet in comes from the servers sites
                     self._redirect_to_client(event, ip_packet)
+                else:
+                    # not the LB's traffic, no rule would take it either
+                    self._drop(event)
                 return
 
         return
 
-    def _select_server(self):
+    def _arp_reply(self, event, arp_packet, mac):
+        """
+        Return the packed packet_out answering an ARP request with mac.
+
+        Replies only depend on the answer, the requester and its port, so
+        they are packed once and then sent as they are.
+        """
+        key = (arp_packet.protodst, mac, arp_packet.hwsrc, arp_packet.protosrc, event.port)
+        data = self._arp_replies.get(key)
+        if data is not None:
+            self._arp_replies.move_to_end(key)
+            return data
+
+        # Create ARP reply
+        arp_reply = arp()
+        arp_reply.hwsrc = mac                        # MAC of real responder
+        arp_reply.hwdst = arp_packet.hwsrc           # MAC of requester
+        arp_reply.opcode = arp.REPLY
+        arp_reply.protosrc = arp_packet.protodst     # IP being requested
+        arp_reply.protodst = arp_packet.protosrc     # IP of requester
+
+        # Create ethernet packet
+        ether = ethernet()
+        ether.type = ethernet.ARP_TYPE
+        ether.dst = arp_packet.hwsrc                 # Send to requester
+        ether.src = mac                              # From responder
+        ether.payload = arp_reply
+
+        # Packet out back through the port the request came from
+        msg = of.ofp_packet_out()
+        msg.data = ether.pack()
+        msg.actions.append(of.ofp_action_output(port = event.port))
+        data = msg.pack()
+        self._arp_replies[key] = data
+        if len(self._arp_replies) > ARP_CACHE_MAX_ENTRIES:
+            self._arp_replies.popitem(last=False)
+        return data
+
+    def _arp_trap(self, vip, command=of.OFPFC_ADD):
+        """
+        Build the flow mod sending ARP requests for a VIP to the controller.
+
+        OpenFlow 1.0 can't rewrite ARP fields, so switches can't answer
+        themselves, but trapped requests aren't flooded any further.
+        """
+        msg = of.ofp_flow_mod(command=command)
+        msg.cookie = ARP_COOKIE
+        msg.priority = ARP_TRAP_PRIORITY
+        # OpenFlow 1.0 matches the ARP opcode and target IP as nw_proto/nw_dst
+        msg.match = of.ofp_match(dl_type=ethernet.ARP_TYPE, nw_proto=arp.REQUEST, nw_dst=vip)
+        msg.actions.append(of.ofp_action_output(port=of.OFPP_CONTROLLER))
+        return msg
+
+    def _send_to_all(self, msg):
+        for connection in list(self.connections.values()):
+            connection.send(msg)
+
+    def _learn_host(self, event, packet):
+        """
+        Learn where the sender of an ARP or IPv4 packet is.
+
+        Only packets coming in on edge ports (no link to another switch)
+        tell where a host is attached.
+        """
+        if packet.type == ethernet.ARP_TYPE:
+            ip = packet.payload.protosrc
+        elif packet.type == ethernet.IP_TYPE:
+            ip = packet.payload.srcip
+        else:
+            return
+        if ip == IP_ANY or ip in self.vips:
+            return
+        if core.hasComponent("openflow_discovery") \
+        and not core.openflow_discovery.is_edge_port(event.dpid, event.port):
+            return
+        if self.hosts.learn(ip, packet.src, event.dpid, event.port):
+            log.debug("Host %s is at %s.%s", ip, dpid_to_str(event.dpid), event.port)
+            self._probed.pop(ip, None)
+            if self.partitions is not None:
+                self.partitions.invalidate()
+
+    def _probe(self, ip, service):
+        """
+        Send an ARP request for a host out of every edge port, so its reply
+        tells where it is.
+        """
+        now = time()
+        if now - self._probed.get(ip, 0) < PROBE_INTERVAL:
+            return
+        self._probed[ip] = now
+        request = arp()
+        request.opcode = arp.REQUEST
+        request.hwsrc = service.mac
+        request.hwdst = ETHER_ANY
+        request.protosrc = service.vip
+        request.protodst = ip
+        ether = ethernet(type=ethernet.ARP_TYPE, src=service.mac, dst=ETHER_BROADCAST)
+        ether.payload = request
+        data = ether.pack()
+        discovery = core.openflow_discovery if core.hasComponent("openflow_discovery") else None
+        for dpid, connection in list(self.connections.items()):
+            msg = of.ofp_packet_out(data=data)
+            for port in connection.ports.keys():
+                if port >= of.OFPP_MAX:
+                    continue
+                if discovery is not None and not discovery.is_edge_port(dpid, port):
+                    continue
+                msg.actions.append(of.ofp_action_output(port=port))
+            if msg.actions:
+                connection.send(msg)
+
+    def _deliver(self, event, ip):
+        """
+        Send the packet of a PacketIn straight to a known host's edge port.
+        """
+        location = self.hosts.get(ip)
+        if location is None:
+            return
+        dpid, port = location
+        if dpid == event.dpid:
+            event.connection.send(self._packet_out(event, [of.ofp_action_output(port=port)]))
+        else:
+            self.send_message_to_switch(dpid, of.ofp_packet_out(
+                data=event.ofp.data, actions=[of.ofp_action_output(port=port)]))
+
+    def _select_server(self, service, key=None):
         #log.debug("ENTER: " + inspect.currentframe().f_code.co_name)
         """
-        Select the backend server with the least active connections.
+        Select the backend server of a service with the least active connections.
+
+        Connections assigned since the last complete stats round are counted
+        in server_pool as pending ones until a round includes them. See
+        Service.select for the other policies.
         """
-        return min(self.server_pool, key=self.server_pool.get)
+        # entries never confirmed by stats (e.g. the connection ended before
+        # a round saw it) stop counting after PENDING_TIMEOUT
+        service.drop_pending(time() - PENDING_TIMEOUT)
+        return service.select(key)
 
-    def _redirect_to_server(self, event, ip_packet, server):
+    def _redirect_to_server(self, event, ip_packet, service, server, key, new_connection=True):
         """
         Modify packet headers and redirect to the selected backend server.
+
+        new_connection is False when the connection already had this server
+        and its flows are just being installed again.
         """
         #log.info("redirect to server")
 
         packet = event.parsed
-        connection_og = event.connection
-
-        dpid_client = self.host_port_map[ip_packet.srcip][0]
-        dpid_server = self.host_port_map[server][0]
-
-        self._request_Path(dpid1=dpid_client, dpid2=dpid_server)
-
-        while self.tmpPath is None:
-            pass
-
-        # create flow mod for the path
-        self.tmpPath.reverse()
-        for i, dpid in enumerate(self.tmpPath):
-            connection = self.get_switch_connection(str_to_dpid(ZERO_DPID + f"{dpid}"))
-            if dpid == self.tmpPath[0]:
-                port_server = self.host_port_map[server][1]
-                self._install_flow(connection, port_server, self._ip_to_mac(server), server, packet)
-                #log.info(f"Install flow in {dpid}:{port_server}")
-                
-            elif dpid == self.tmpPath[-1]:
-                port_server = self.paths[dpid][self.tmpPath[i-1]]
-                self._install_flow_with_change(connection, port_server, self._ip_to_mac(server), server, packet)
-                msg = of.ofp_packet_out(data=event.ofp)
-                msg.actions.append(of.ofp_action_output(port=port_server))
-                connection_og.send(msg)
-                #log.info(f"Install flow in {dpid}:{port_server}")
-                
-            else:
-                port_server = self.paths[dpid][self.tmpPath[i-1]]
-                self._install_flow(connection, port_server, self._ip_to_mac(server), server, packet)
-                #log.info(f"Install flow in {dpid}:{port_server}")
-                
-                
-        self.tmpPath = None
 
+        if server not in self.hosts:
+            # the packet is dropped, the client's retransmission finds it
+            self._probe(server, service)
+            self._drop(event)
+            return
+        if ip_packet.srcip not in self.hosts:
+            self._drop(event)
+            return
+        dpid_client = self.hosts[ip_packet.srcip][0]
+        dpid_server = self.hosts[server][0]
+
+        path = self._request_Path(dpid1=dpid_client, dpid2=dpid_server)
+        if path is None:
+            self._drop(event)
+            return
+
+        match = of.ofp_match.from_packet(packet)
+        now = time()
+        pkey = (key[0], key[3], key[4])
+        timeouts = self.timeout_policy.timeouts(pkey, now)
+        self.timeout_policy.installed(pkey, now)
+
+        # create flow mods for the path, the last one is on the client's switch
+        path.reverse()
+        flows = self._server_flows(path, match, service, server, timeouts)
+        if flows is None:
+            self._drop(event)
+            return
+        ingress = flows.pop()
+
+        if self.install_reverse:
+            # the server's replies go back over the same switches, so the
+            # return path can be installed now instead of on the first reply
+            reverse = self._client_flows(path[::-1], self._reverse_match(match, server),
+                                         ip_packet.srcip, packet.src, service, timeouts)
+            if reverse is None:
+                self._drop(event)
+                return
+            flows += reverse
+
+        self._install_path(event, key, flows, ingress)
+        self.affinity.put(key, server)
+        self.reply_services.put((key[0], key[3], server, key[4]), service)
+        if self.track_flow_removed and len(path) == 1:
+            # the rewriting flow is the counted one
+            self.tracked_rewrites.put((key[0], key[3], key[1], key[4]), server)
+        service.assigned(server, new_connection, self.track_flow_removed)
 
     def _redirect_to_client(self, event, ip_packet):
         """
         Redirect traffic from backend servers to the client.
         """
         packet = event.parsed
-        connection_og = event.connection
 
-        dpid_server = self.host_port_map[ip_packet.dstip][0]
-        dpid_client = self.host_port_map[ip_packet.srcip][0]
+        key = self._connection_key(ip_packet)
+        service = self._connection_service(key[1], key[4], key[0], key[3])
+        if service is None:
+            self._drop(event)
+            return
 
-        self._request_Path(dpid1=dpid_client, dpid2=dpid_server)
-        #log.info("request path sent")
+        if ip_packet.dstip not in self.hosts:
+            self._probe(ip_packet.dstip, service)
+            self._drop(event)
+            return
+        if ip_packet.srcip not in self.hosts:
+            # e.g. the server's port isn't an edge port for discovery yet
+            self._probe(ip_packet.srcip, service)
+            self._drop(event)
+            return
+        dpid_server = self.hosts[ip_packet.dstip][0]
+        dpid_client = self.hosts[ip_packet.srcip][0]
 
-        while self.tmpPath is None:
-            pass
+        path = self._request_Path(dpid1=dpid_client, dpid2=dpid_server)
+        if path is None:
+            self._drop(event)
+            return
         
-        # create flow mod for the path
-        self.tmpPath.reverse()
-        for i, dpid in enumerate(self.tmpPath):
-            connection = self.get_switch_connection(str_to_dpid(ZERO_DPID + f"{dpid}"))
-            if dpid == self.tmpPath[-1]:
-                port_client = self.paths[dpid][self.tmpPath[i-1]]
-                self._install_flow(connection, port_client, packet.dst, ip_packet.dstip, packet)
-                msg = of.ofp_packet_out(data=event.ofp)
-                msg.actions.append(of.ofp_action_dl_addr.set_dst(packet.dst))
-                msg.actions.append(of.ofp_action_nw_addr.set_dst(ip_packet.dstip))
-                msg.actions.append(of.ofp_action_output(port=port_client))
-                connection_og.send(msg)
-                #log.info(f"Install flow in {dpid}:{port_client}")
-                
-            elif dpid == self.tmpPath[0]:
-                port_client = self.host_port_map[ip_packet.dstip][1]
-                self._install_flow_with_change(connection, port_client, packet.dst, ip_packet.dstip, packet, True)
-                #log.info(f"Install flow in {dpid}:{port_client}")
-    
+        # same connection as seen from the client's side
+        timeouts = self.timeout_policy.timeouts((key[1], key[4], key[3]), time())
+
+        # create flow mods for the path, the last one is on the server's switch
+        path.reverse()
+        flows = self._client_flows(path, of.ofp_match.from_packet(packet),
+                                   ip_packet.dstip, packet.dst, service, timeouts)
+        if flows is None:
+            self._drop(event)
+            return
+        ingress = flows.pop()
+        self._install_path(event, key, flows, ingress)
+
+    def _server_flows(self, path, match, service, server, timeouts=(IDLE_TIMEOUT, HARD_TIMEOUT)):
+        """
+        Build the flow mods carrying a client's packets to the server.
+
+        path starts at the server's edge switch and ends at the client's one,
+        so the returned (dpid, flow_mod) list goes from the far end toward
+        the ingress. The last flow mod rewrites the virtual addresses.
+        Returns None if the port of a hop isn't known.
+        """
+        server_mac = self.hosts.mac(server)
+        match = FlowTemplates.pack_match(match)
+        flows = []
+        for i, dpid in enumerate(path):
+            if i == 0:
+                port_server = self.hosts[server][1]
             else:
-                port_client = self.paths[dpid][self.tmpPath[i-1]]
-                self._install_flow(connection, port_client, packet.dst, ip_packet.dstip, packet)
-                #log.info(f"Install flow in {dpid}:{port_client}")
-    
-        self.tmpPath = None
+                port_server = self._hop_port(dpid, path[i-1])
+                if port_server is None:
+                    return None
+            if i == len(path) - 1:
+                msg = self._flow_with_change(port_server, server_mac, server, match, service,
+                                             timeouts=timeouts)
+            else:
+                msg = self._flow(port_server, server_mac, server, match, timeouts=timeouts)
+            flows.append((dpid, msg))
+
+        if self.track_flow_removed:
+            # the rule on the server's switch stands for the connection
+            flows[0][1].cookie = CONNECTION_COOKIE
+            flows[0][1].flags |= of.OFPFF_SEND_FLOW_REM
+        return flows
+
+    def _client_flows(self, path, match, client_ip, client_mac, service,
+                      timeouts=(IDLE_TIMEOUT, HARD_TIMEOUT)):
+        """
+        Build the flow mods carrying a server's replies back to the client.
+
+        path starts at the client's edge switch and ends at the server's one,
+        so the returned (dpid, flow_mod) list goes from the far end toward
+        the ingress. The first flow mod rewrites the source addresses.
+        Returns None if the port of a hop isn't known.
+        """
+        match = FlowTemplates.pack_match(match)
+        flows = []
+        for i, dpid in enumerate(path):
+            if i == 0:
+                port_client = self.hosts[client_ip][1]
+                msg = self._flow_with_change(port_client, client_mac, client_ip, match, service,
+                                             True, timeouts)
+            else:
+                port_client = self._hop_port(dpid, path[i-1])
+                if port_client is None:
+                    return None
+                msg = self._flow(port_client, client_mac, client_ip, match, timeouts=timeouts)
+            flows.append((dpid, msg))
+        return flows
+
+    def _hop_port(self, dpid1, dpid2):
+        """
+        Return the port of dpid1 toward dpid2 (None if it isn't known).
+        """
+        # from the same live links as the path
+        port = core.openflow_discGraph.get_port(dpid1, dpid2)
+        if port is None:
+            log.debug("No port known from %s to %s, not installing the path",
+                      dpid_to_str(dpid1), dpid_to_str(dpid2))
+        return port
+
+    def _reverse_match(self, match, server):
+        """
+        Build the match of a server's replies from a client's match.
+        """
+        reverse = match.clone()
+        reverse.dl_src, reverse.dl_dst = self.hosts.mac(server), match.dl_src
+        reverse.nw_src, reverse.nw_dst = server, match.nw_src
+        reverse.tp_src, reverse.tp_dst = match.tp_dst, match.tp_src
+        return reverse
 
-    def _install_flow(self, connection, out_port, dst_mac, dst_ip, packet, src_ip=None, src_mac=None):
+    def _connection_key(self, ip_packet):
+        """
+        Return the (src ip, dst ip, protocol, src port, dst port) of a packet.
+        """
+        l4 = ip_packet.payload
+        return (ip_packet.srcip, ip_packet.dstip, ip_packet.protocol,
+                getattr(l4, 'srcport', None), getattr(l4, 'dstport', None))
+
+    def _install_path(self, event, key, flows, ingress):
+        """
+        Install a path and release the packet which triggered it.
+
+        Every switch gets its flow mods followed by a barrier in one write,
+        starting from the far end. Only when all barrier replies are in, the
+        ingress flow mod is sent and the packet is released, so it can't
+        miss a rule further down the path.
+        """
+        install = PathInstall(key, event, ingress)
+        self._installing[key] = install
+        self.install_counters['paths'] += 1
+
+        per_switch = {}
+        for dpid, msg in flows:
+            per_switch.setdefault(dpid, []).append(msg)
+
+        for dpid, msgs in per_switch.items():
+            connection = self.get_switch_connection(dpid)
+            if connection is None:
+                log.warning("No connection to %s, path may be incomplete", dpid_to_str(dpid))
+                continue
+            barrier = of.ofp_barrier_request()
+            connection.send(b''.join(msg.pack() for msg in msgs) + barrier.pack())
+            install.barriers.add(barrier.xid)
+            self._pending_barriers[barrier.xid] = install
+
+        if not install.barriers:
+            self._finish_install(install)
+            return
+        self.install_counters['held_packet_outs'] += 1
+        core.callDelayed(BARRIER_TIMEOUT, self._barrier_timeout, install)
+
+    def _handle_BarrierIn(self, event):
+        install = self._pending_barriers.pop(event.xid, None)
+        if install is None:
+            return
+        install.barriers.discard(event.xid)
+        if not install.barriers:
+            self._finish_install(install)
+
+    def _barrier_timeout(self, install):
+        if install.done:
+            return
+        log.debug("Barrier replies missing, releasing packet anyway")
+        self.install_counters['barrier_timeouts'] += 1
+        for xid in install.barriers:
+            self._pending_barriers.pop(xid, None)
+        install.barriers.clear()
+        self._finish_install(install)
+
+    def _finish_install(self, install):
+        """
+        Send the ingress flow mod and release the held packets.
+        """
+        install.done = True
+        if self._installing.get(install.key) is install:
+            del self._installing[install.key]
+
+        event = install.event
+        dpid, flow_mod = install.ingress
+        if dpid == event.dpid and event.ofp.buffer_id is not None:
+            # the switch applies the new flow to the buffered packet itself
+            flow_mod.buffer_id = event.ofp.buffer_id
+            event.connection.send(flow_mod.pack())
+        elif dpid == event.dpid:
+            msg = self._packet_out(event, list(flow_mod.actions))
+            event.connection.send(flow_mod.pack() + msg.pack())
+        else:
+            # the packet came in somewhere down the path, where the rules are
+            # already in place
+            self.send_message_to_switch(dpid, flow_mod.pack())
+            event.connection.send(self._packet_out(event, [of.ofp_action_output(port=of.OFPP_TABLE)]))
+
+        # packets which came in while the path was being installed
+        for waiting in install.waiting:
+            waiting.connection.send(self._packet_out(waiting, [of.ofp_action_output(port=of.OFPP_TABLE)]))
+
+    def _packet_out(self, event, actions):
+        """
+        Build a packet_out releasing the packet of a PacketIn.
+
+        Refers to the switch's buffer when it has one and carries the packet
+        data only when the switch didn't buffer it.
+        """
+        msg = of.ofp_packet_out(in_port=event.port, actions=actions)
+        if event.ofp.buffer_id is not None:
+            msg.buffer_id = event.ofp.buffer_id
+        else:
+            msg.data = event.ofp.data
+            self.install_counters['unbuffered_packet_outs'] += 1
+        return msg
+
+    def _flow(self, out_port, dst_mac, dst_ip, match, timeouts=(IDLE_TIMEOUT, HARD_TIMEOUT)):
         #log.debug("ENTER: " + inspect.currentframe().f_code.co_name)
-        msg = of.ofp_flow_mod()
-        msg.match = of.ofp_match.from_packet(packet)
-        msg.match.dl_dst = dst_mac
-        msg.match.nw_dst = dst_ip
-        msg.match.nw_proto = None
-        msg.idle_timeout = IDLE_TIMEOUT
-        msg.hard_timeout = HARD_TIMEOUT
-        #log.info(f"dst: {msg.match.nw_dst} src: {msg.match.nw_src}")
-        if not src_ip and src_mac:
-            msg.match.dl_src = src_mac
-            msg.match.nw_src = src_ip
-
-        msg.actions.append(of.ofp_action_output(port=out_port))
-        
-        connection.send(msg)
+        """
+        Build a flow entry that forwards toward dst_ip
+
+        match is the packed match of the connection (FlowTemplates.pack_match).
+        """
+        return self.flow_templates.forward(out_port, dst_mac, dst_ip, match, timeouts)
 
-    def _install_flow_with_change(self, connection, out_port, dst_mac, dst_ip, packet, is_to_client=False):
+    def _flow_with_change(self, out_port, dst_mac, dst_ip, match, service, is_to_client=False,
+                          timeouts=(IDLE_TIMEOUT, HARD_TIMEOUT)):
         #log.debug("ENTER: " + inspect.currentframe().f_code.co_name)
         """
-        Install a single flow entry that modifies addresses and forwards
+        Build a single flow entry that modifies addresses (to or from the
+        service's VIP) and forwards
         """
-        #log.info("install flow change")
-        msg = of.ofp_flow_mod()
-        msg.match = of.ofp_match.from_packet(packet)
-        
         if is_to_client:
-            msg.actions.append(of.ofp_action_dl_addr.set_src(self.virtual_mac))
-            msg.actions.append(of.ofp_action_nw_addr.set_src(self.virtual_ip))
-        else:
-            msg.match.nw_dst = self.virtual_ip
-            msg.match.dl_dst = self.virtual_mac
-            msg.actions.append(of.ofp_action_dl_addr.set_dst(dst_mac))
-            msg.actions.append(of.ofp_action_nw_addr.set_dst(dst_ip))
-        msg.actions.append(of.ofp_action_output(port=out_port))
-        msg.match.nw_proto = None
-        msg.idle_timeout = IDLE_TIMEOUT
-        msg.hard_timeout = HARD_TIMEOUT
-        #log.info(f"dst: {msg.match.nw_dst} src: {msg.match.nw_src}")
-        connection.send(msg)
+            return self.flow_templates.to_client(out_port, match, service, timeouts)
+        return self.flow_templates.to_server(out_port, dst_mac, dst_ip, match, service, timeouts)
+
+    def _drop(self, event):
+        """
+        Drop the packet of a PacketIn, freeing the switch's buffer.
+        """
+        if event.ofp.buffer_id is not None:
+            event.connection.send(of.ofp_packet_out(buffer_id=event.ofp.buffer_id,
+                                                    in_port=event.port))
 
     def _flood(self, event):
         #log.debug("ENTER: " + inspect.currentframe().f_code.co_name)
         """
         Flood packets as a fallback.
         """
-        msg = of.ofp_packet_out(data=event.ofp)
-        msg.actions.append(of.ofp_action_output(port=of.OFPP_TABLE))
-        event.connection.send(msg)
+        event.connection.send(self._packet_out(event, [of.ofp_action_output(port=of.OFPP_TABLE)]))
     
-    def _request_flow_stats(self, connection):
+    def _request_flow_stats(self, connection, server=None):
         #log.debug("ENTER: " + inspect.currentframe().f_code.co_name)
+        """
+        Send a stats request, returns its xid (None if not sent).
+
+        Without a server the whole flow table is asked for. With a server
+        only the LB's flows toward it are, as a flow list ('filtered' stats
+        mode) or just their number ('aggregate' stats mode). Flows toward
+        a VIP are always asked for as a list, their server is in the actions.
+        """
         # Construct flow stats request
         if connection is not None:
             #log.debug("Sending flow stats request to %s", dpid_to_str(connection.dpid))
             request = of.ofp_stats_request()
-            request.type = of.OFPST_FLOW
-            request.body = of.ofp_flow_stats_request()
+            if server is None:
+                request.type = of.OFPST_FLOW
+                request.body = of.ofp_flow_stats_request()
+            else:
+                match = of.ofp_match(dl_type=ethernet.IP_TYPE, nw_dst=server)
+                if self.stats_mode == 'aggregate' and server not in self.vips:
+                    request.type = of.OFPST_AGGREGATE
+                    request.body = of.ofp_aggregate_stats_request(match=match, table_id=LB_TABLE)
+                else:
+                    request.type = of.OFPST_FLOW
+                    request.body = of.ofp_flow_stats_request(match=match, table_id=LB_TABLE)
             connection.send(request)
+            return request.xid
+        return None
+
+    def _stats_targets(self):
+        """
+        Return the (dpid, server) pairs to ask for stats in a round.
+        """
+        if self.stats_mode == 'flow':
+            # the whole table of every switch a backend is on
+            return [(dpid, None) for dpid in
+                    set(self.hosts[server][0] for server in self.backends if server in self.hosts)]
+        # one small request per backend, to the switch the backend is on
+        targets = [(self.hosts[server][0], server) for server in self.backends
+                   if server in self.hosts]
+        # clients on a backend's own switch have just the flow rewriting
+        # the VIP there, so the VIP's flows are asked for as well
+        vip_targets = set()
+        for service in self.services.values():
+            for server in service.server_pool:
+                if server in self.hosts:
+                    vip_targets.add((self.hosts[server][0], service.vip))
+        return targets + list(vip_targets)
 
     def _stats_loop(self):
         #log.debug("ENTER: " + inspect.currentframe().f_code.co_name)
         """Thread function that periodically requests stats"""
         while self.running:
-            print(self.server_pool)
-            self.stats_from = []
-            self.server_pool= {IPAddr(f'10.0.0.{i}'):0 for i in range(1,5)} # server ip: connections count
-            for dpid in self.dpids:
-                if dpid in self.connections:
-                    self._request_flow_stats(self.connections[dpid])
-                else:
-                    log.debug("No connection for DPID %s", dpid_to_str(dpid))
-            # Wait for 3 seconds before next round
-            sleep(REQUEST_FOR_STATS_INTERVAL)
+            for service in list(self.services.values()):
+                log.debug("Connections of %s: %s", service, service.server_pool)
+                if service.policy == 'least_bandwidth':
+                    log.debug("Throughput of %s (bytes/s): %s", service, service.throughput)
+            log.debug("Path installs: %s", dict(self.install_counters))
+            log.debug("Reinstalls with %s timeouts: %s of %s installs (fixed timeouts: ~%s)",
+                      self.timeout_policy.name, self.timeout_policy.reinstalls,
+                      self.timeout_policy.installs, self.timeout_policy.fixed_reinstalls)
+            # rounds are run by the cooperative thread, like the replies
+            core.callLater(self._start_stats_round)
+            sleep(self.stats_interval)
+
+    def _start_stats_round(self):
+        """
+        Start a new round of connection counting.
+
+        Replies are counted into the services' server_pool_tmp, and their
+        server_pool is only updated from it once every request of this round
+        has been answered, so selection always sees the last complete round.
+        """
+        self._check_services_file()
+        if self.stats_requests:
+            log.debug("Stats round %s incomplete, no reply from %s", self.stats_round,
+                      ", ".join(dpid_to_str(d) for d, _ in self.stats_requests.values()))
+        self.stats_round += 1
+        self.stats_round_started = time()
+        self.stats_requests = {}
+        self.stats_from = []
+        for service in self.services.values():
+            service.start_round()
+        self.timeout_policy.expire(self.stats_round_started - AFFINITY_IDLE_TIMEOUT)
+        for dpid, server in self._stats_targets():
+            xid = self._request_flow_stats(self.connections.get(dpid), server)
+            if xid is None:
+                log.debug("No connection for DPID %s", dpid_to_str(dpid))
+                continue
+            self.stats_requests[xid] = (dpid, server)
+
+    def _stats_reply(self, event):
+        """
+        Return the (dpid, server) request a stats reply answers, if it
+        belongs to the current round.
+        """
+        # flow stats carry all reply parts, aggregate stats just one
+        ofp = event.ofp[0] if isinstance(event.ofp, list) else event.ofp
+        request = self.stats_requests.pop(ofp.xid, None)
+        if request is not None and request[0] not in self.stats_from:
+            self.stats_from.append(request[0])
+        return request
 
     def _handle_FlowStatsReceived(self, event):
         # log.info("ENTER: " + inspect.currentframe().f_code.co_name)
         # Process flow stats reply
         #log.info("Received flow stats from %s", dpid_to_str(event.connection.dpid))
+        if self.partitions is not None and self.partitions.handle_stats(event):
+            return
+        request = self._stats_reply(event)
+        if request is None:
+            # reply to an earlier round or to someone else's request
+            return
+        filtered = request[1] is not None
+        now = time()
+        dpid = event.connection.dpid
         for flow in event.stats:
+            # OpenFlow 1.0 can't ask by cookie, so skip foreign flows here
+            if filtered and flow.cookie not in (LB_COOKIE, CONNECTION_COOKIE):
+                continue
             # Check if flow has IP addresses
-            if flow.match.nw_src and flow.match.nw_dst in self.server_pool.keys() \
-            and event.connection.dpid not in self.stats_from:
-                # Convert IP addresses to strings
-                #self.stats_from.append(event.connection.dpid)
-                self.server_pool[flow.match.nw_dst] += 1
+            if not flow.match.nw_src:
+                continue
+            server = flow.match.nw_dst
+            if server in self.vips:
+                # only the rewriting flow of a client on the server's own
+                # switch stands for a connection, the others are counted
+                # toward the server further down the path
+                service = self._service(server, flow.match.tp_dst)
+                server = self._rewritten_server(flow.actions)
+                if service is None or server not in service.server_pool \
+                or self.hosts.get(server, (None,))[0] != dpid:
+                    continue
+                services = [service]
+            elif server in self.backends:
+                # transit flows on another backend's switch aren't counted
+                if self.hosts.get(server, (None,))[0] != dpid:
+                    continue
+                service = self._connection_service(flow.match.nw_src, flow.match.tp_src,
+                                                   server, flow.match.tp_dst)
+                if service is None:
+                    continue
+                services = [service]
+            else:
+                continue
+            for service in services:
+                service.count(server, 1, (flow.match.nw_src, server,
+                              flow.match.tp_src, flow.match.tp_dst), flow.byte_count)
+            self.timeout_policy.observe((flow.match.nw_src, flow.match.tp_src, flow.match.tp_dst),
+                                        flow.byte_count, flow.duration_sec, now)
+        self._end_stats_reply()
 
-            
+    @staticmethod
+    def _rewritten_server(actions):
+        """
+        Return the server a flow rewrites the VIP to (None if it doesn't).
+        """
+        for action in actions:
+            if action.type == of.OFPAT_SET_NW_DST:
+                return action.nw_addr
+        return None
+
+    def _handle_AggregateFlowStatsReceived(self, event):
+        request = self._stats_reply(event)
+        if request is None:
+            return
+        # all the server's flows, so a server of several services counts
+        # them in each; in a round where flows expired only what the total
+        # grew by is counted, so their bytes since the last round are lost
+        server = request[1]
+        for service in self.backends.get(server, ()):
+            service.count(server, event.stats.flow_count, server, event.stats.byte_count,
+                          aggregate=True)
+        self._end_stats_reply()
 
-    def get_flows(self):
-        """Return the collected flow tuples"""
-        return self.flows
+    def _end_stats_reply(self):
+        if not self.stats_requests:
+            # every request of this round was answered
+            for service in self.services.values():
+                service.end_round(self.stats_round_started, self.track_flow_removed)
+
+    def _handle_FlowRemoved(self, event):
+        if not self.track_flow_removed or event.ofp.cookie != CONNECTION_COOKIE:
+            return
+        match = event.ofp.match
+        server = match.nw_dst
+        if server in self.vips:
+            # a client on the server's own switch, the server isn't in the match
+            service = self._service(server, match.tp_dst)
+            rewrite = (match.nw_src, match.tp_src, match.nw_dst, match.tp_dst)
+            server = self.tracked_rewrites.get(rewrite)
+            self.tracked_rewrites.discard(rewrite)
+            if service is not None and server in service.server_pool:
+                service.count_connection(server, -1)
+            return
+        # only the service the connection was counted in
+        service = self._connection_service(match.nw_src, match.tp_src, server, match.tp_dst)
+        if service is not None:
+            service.count_connection(server, -1)
 
     def stop(self):
         """Stop the stats collection thread"""
         self.running = False
         self.stats_thread.join()
 
-    def _ip_to_mac(self, ip):
-        return EthAddr(MAC_ZERO + ip.toStr()[-1])
-
-def launch():
+def launch(install_reverse=False, track_flow_removed=False, stats_mode='flow',
+           timeouts='fixed', proactive=False, client_net='10.0.0.0/24', partition_bits=8,
+           policy='least_connections', weights='', choices=CHOICES, services=''):
     """
     Launch the Least Connection Load Balancer.
+
+    --install_reverse installs the return path on the client's first packet.
+    --track_flow_removed counts connections from flow installs and FlowRemoved
+    messages, polling stats only every RECONCILE_INTERVAL to correct them.
+    --stats_mode=flow|filtered|aggregate picks what is asked from switches
+    for connections stats (see STATS_MODES).
+    --timeouts=fixed|adaptive picks the flow timeout policy. Adaptive
+    timeouts grow with a connection's age and rate, which needs per-flow
+    stats (the flow or filtered stats mode) for the rate.
+    --proactive splits --client_net into 2**--partition_bits prefixes and
+    installs wildcard rules sending each prefix to a server, rebalanced in
+    the background (see PartitionBalancer).
+    --policy picks the server selection policy (see POLICIES), for the
+    weighted one --weights=10.0.0.1:2,10.0.0.2:0.5 gives server capacities
+    (1 when not given).
+    --choices=d compares only d random servers per selection (2 for power
+    of two choices), 0 compares all of them.
+    The maglev policy takes --weights too, as the share of table slots.
+    --services=file.json loads the services (VIPs and their servers) from
+    a file, reloaded when it changes (see LeastConnectionLB.load_services),
+    instead of the single 10.0.0.100 service of 10.0.0.1-4. --policy,
+    --weights and --choices are then the defaults of its services.
+    """
+    if stats_mode not in STATS_MODES:
+        raise RuntimeError(f"Unknown stats mode {stats_mode}, use one of {', '.join(STATS_MODES)}")
+    if timeouts not in TIMEOUT_POLICIES:
+        raise RuntimeError(f"Unknown timeout policy {timeouts}, use one of {', '.join(TIMEOUT_POLICIES)}")
+    if policy not in POLICIES:
+        raise RuntimeError(f"Unknown policy {policy}, use one of {', '.join(POLICIES)}")
+    server_weights = {}
+    for item in weights.split(','):
+        if item:
+            ip, weight = item.split(':')
+            server_weights[IPAddr(ip)] = float(weight)
+            if server_weights[IPAddr(ip)] <= 0:
+                raise RuntimeError(f"Weight of {ip} has to be positive")
+    if int(choices) < 0:
+        raise RuntimeError("Number of choices can't be negative")
+    core.registerNew(LeastConnectionLB, install_reverse=str_to_bool(install_reverse),
+                     track_flow_removed=str_to_bool(track_flow_removed),
+                     stats_mode=stats_mode, timeout_policy=timeouts,
+                     proactive=str_to_bool(proactive), client_net=client_net,
+                     partition_bits=int(partition_bits), policy=policy,
+                     weights=server_weights, choices=int(choices),
+                     services_file=services or None)
+
+def bench(servers=64, connections=200000, lifetime=2000, refresh=500, choices='1,2,3'):
     """
-    core.registerNew(LeastConnectionLB)
+    Compare server selection methods on simulated traffic.
+
+    One connection arrives per step and lasts a random number of steps (up
+    to 2 * lifetime). Like in the LB every selection counts the connection
+    in at once, while ended connections leave the counts only when stats
+    are refreshed (every refresh steps). Logs the selection time and the
+    average spread (max - min) of the real counts at the refreshes for:
+    min() over a dict (the original policy), the heap and d-choices for each
+    d in --choices.
+    """
+    servers, connections = int(servers), int(connections)
+    lifetime, refresh = int(lifetime), int(refresh)
+    ips = [IPAddr(0x0a000001 + i) for i in range(servers)]
+
+    def run(name, select, count):
+        random.seed(0)
+        actual = dict.fromkeys(ips, 0)
+        ends = []
+        spread = []
+        took = 0.0
+        for step in range(connections):
+            while ends and ends[0][0] <= step:
+                actual[heapq.heappop(ends)[1]] -= 1
+            if step % refresh == 0:
+                for server, n in actual.items():
+                    count(server, n)
+                spread.append(max(actual.values()) - min(actual.values()))
+            start = perf_counter()
+            server = select()
+            took += perf_counter() - start
+            count(server, None)
+            actual[server] += 1
+            heapq.heappush(ends, (step + random.randint(1, 2 * lifetime), server))
+        log.info("%-10s %8.0f ns/selection, average spread %.1f", name,
+                 took / connections * 1e9, sum(spread) / len(spread))
+
+    counts = dict.fromkeys(ips, 0)
+    def count_dict(server, n):
+        counts[server] = counts[server] + 1 if n is None else n
+    run("min()", lambda: min(counts, key=counts.get), count_dict)
+
+    methods = [("heap", 0)] + [(f"d={d}", int(d)) for d in choices.split(',') if d]
+    for name, d in methods:
+        pool = ServerPool(ips)
+        def count_pool(server, n):
+            if n is None:
+                pool.add(server, 1)
+            else:
+                pool.set(server, n)
+        select = pool.select if not d else (lambda pool=pool, d=d: pool.select_sampled(d))
+        run(name, select, count_pool)
+
+def bench_flows(hops=4, connections=20000):
+    """
+    Compare building a connection's path flow mods from objects (as the LB
+    did before FlowTemplates) with stamping them from templates.
+
+    Each connection gets --hops flow mods, the last one rewriting the VIP
+    to a server, all of them packed. Logs the time per connection.
+    """
+    hops, connections = int(hops), int(connections)
+    service = Service('10.0.0.100', servers=[IPAddr('10.0.0.1')])
+    server, server_mac = IPAddr('10.0.0.1'), EthAddr('00:00:00:00:00:01')
+    packets = []
+    for i in range(connections):
+        packet = ethernet(src=EthAddr('00:00:00:00:00:05'), dst=service.mac, type=ethernet.IP_TYPE)
+        packet.payload = ipv4(srcip=IPAddr('10.0.0.5'), dstip=service.vip,
+                              protocol=ipv4.TCP_PROTOCOL)
+        packet.payload.payload = tcp(srcport=1024 + i % 60000, dstport=1001)
+        packets.append(packet)
+
+    def objects(match):
+        msgs = []
+        for hop in range(hops):
+            msg = of.ofp_flow_mod()
+            msg.cookie = LB_COOKIE
+            msg.match = match.clone()
+            if hop < hops - 1:
+                msg.match.dl_dst = server_mac
+                msg.match.nw_dst = server
+            else:
+                msg.match.nw_dst = service.vip
+                msg.match.dl_dst = service.mac
+                msg.actions.append(of.ofp_action_dl_addr.set_dst(server_mac))
+                msg.actions.append(of.ofp_action_nw_addr.set_dst(server))
+            msg.actions.append(of.ofp_action_output(port=hop + 1))
+            msg.match.nw_proto = None
+            msg.idle_timeout, msg.hard_timeout = IDLE_TIMEOUT, HARD_TIMEOUT
+            msgs.append(msg)
+        return b''.join(msg.pack() for msg in msgs)
+
+    templates = FlowTemplates()
+    def stamped(match):
+        match = FlowTemplates.pack_match(match)
+        msgs = [templates.forward(hop + 1, server_mac, server, match) for hop in range(hops - 1)]
+        msgs.append(templates.to_server(hops, server_mac, server, match, service))
+        return b''.join(msg.pack() for msg in msgs)
+
+    for name, build in (("objects", objects), ("templates", stamped)):
+        start = perf_counter()
+        for packet in packets:
+            build(of.ofp_match.from_packet(packet, 1))
+        took = perf_counter() - start
+        log.info("%-10s %8.1f us/connection (%s flow mods)", name,
+                 took / connections * 1e6, hops)